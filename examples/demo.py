@@ -13,6 +13,22 @@ GitHub.</p>
 </html>'''
 
 
+@app.after_response
+def add_server_header(req, resp):
+    '''Middleware registered with after_response can modify every
+    response before it is sent.'''
+    if resp.headers is None:
+        resp.headers = {}
+    resp.headers['Server'] = 'noggin'
+
+
+def require_token(req):
+    '''Middleware passed to a single route. Returning a value (or
+    raising HTTPError) stops the request before the body is read.'''
+    if req.headers.get(b'x-token') != b'secret':
+        raise HTTPError(403)
+
+
 @app.route('/')
 def index(req):
     '''Return text to send it to the client'''
@@ -43,7 +59,7 @@ def error(req):
     raise HTTPError(418)
 
 
-@app.route('/echo1', methods=['PUT', 'POST'])
+@app.route('/echo1', methods=['PUT', 'POST'], before=[require_token])
 def echo1(req):
     '''This will echo content back to the client, but will fail for
     "large" requests because everything is read into memory.'''
@@ -57,9 +73,17 @@ def echo2(req):
     yield from req.iter_content()
 
 
-@app.route('/device/([^/]+)/([^/]+)')
+@app.route('/device/<p1>/<int:p2>')
 def parameters(req, p1, p2):
-    '''Match groups in the route will be passed to your function as
-    positional parameters.'''
+    '''Placeholders in the route will be passed to your function as
+    keyword parameters, converted to the given type.'''
+
+    return {'p1': p1, 'p2': p2}
+
+
+@app.route('/regex/([^/]+)/([^/]+)')
+def regex_parameters(req, p1, p2):
+    '''Match groups in a regular expression route will be passed to
+    your function as positional parameters.'''
 
     return {'p1': p1, 'p2': p2}
@@ -3,32 +3,63 @@ try:
 except ImportError:
     import ubinascii as binascii
 
+try:
+    import hashlib
+except ImportError:
+    import uhashlib as hashlib
+
 import errno
 import gc
+import json
 import machine
 import network
 import os
 
-from noggin import Noggin, Response, HTTPError
-from noggin.util import chunked_reader
+from noggin import (Noggin, Response, HTTPError, StreamReader,
+                    chunked_reader)
+from noggin.limits import RateLimiter
 
 # cribbed from
 # https://github.com/micropython/micropython-lib/blob/master/stat/stat.py
 S_IFDIR = 0o040000
 S_IFMT = 0o170000
 
-app = Noggin()
+# Allow each client 5 requests per second, in bursts of up to 10.
+app = Noggin(limiter=RateLimiter(rate=5, burst=10))
 
 
-@app.route('/')
-def index(req):
+@app.on_error
+def filesystem_error(req, err):
+    '''Translate filesystem errors raised by any request handler into
+    HTTP errors.'''
+    if isinstance(err, OSError):
+        if err.args[0] == errno.ENOENT:
+            return Response(404, content='{}: not found'.format(req.uri))
+        else:
+            return Response(500, content=str(err))
+
+
+def send_file(req, path, content_type=None):
+    '''Return a Response streaming the contents of path. HEAD requests
+    only need the size, so the file is not opened.'''
     try:
-        with open('help.html') as fd:
-            return Response(content=chunked_reader(fd),
-                            content_type='text/html')
+        size = os.stat(path)[6]
+        if req.method == 'HEAD':
+            return Response(content_type=content_type, content_length=size)
+        fd = open(path, 'rb')
     except OSError:
         raise HTTPError(404)
 
+    # chunked_reader will close the file once it has been sent.
+    return Response(content=chunked_reader(fd, buf=req.buffer),
+                    content_type=content_type,
+                    content_length=size)
+
+
+@app.route('/')
+def index(req):
+    return send_file(req, 'help.html', content_type='text/html')
+
 
 def get_statvfs():
     statvfs_fields = [
@@ -67,90 +98,482 @@ def mem_free(req):
     }
 
 
-def get_file_list(path):
+def iter_file_list(path):
     '''Recursively list files.
 
-    Returns a list of (name, size, is_dir, children) tuples, where
-    children is a similar list of is_dir is True or None of is_dir
-    is False.
+    Yields a JSON list of [name, size, is_dir, children] lists, where
+    children is a similar list if is_dir is True or null if is_dir
+    is False. This is a generator so that listing a large filesystem
+    does not hold up other requests.
     '''
 
-    files = []
+    sep = b'['
 
     for f in os.listdir(path):
         fp = '/'.join([path, f])
         print('* checking', f)
         s = os.stat(fp)
-        if s[0] & S_IFMT == S_IFDIR:
-            files.append((f, s[6], True, get_file_list(fp)))
+        is_dir = s[0] & S_IFMT == S_IFDIR
+
+        yield sep
+        yield json.dumps([f, s[6], is_dir])[:-1].encode()
+        if is_dir:
+            yield b', '
+            yield from iter_file_list(fp)
+            yield b']'
         else:
-            files.append((f, s[6], False, None))
+            yield b', null]'
 
-    return files
+        sep = b', '
 
+    yield b']' if sep == b', ' else b'[]'
 
-@app.route('/file')
+
+@app.route('/file', cost=5, max_active=1)
 def list_files(req):
     '''Return a list of files'''
-    return get_file_list('/')
+    return Response(content=iter_file_list('/'),
+                    content_type='application/json')
 
 
-@app.route('/file/(.*)')
+@app.route('/file/<path:path>')
 def get_file(req, path):
     '''Retrieve file contents'''
     print('* request to get {}'.format(path))
-    try:
-        with open(path) as fd:
-            while True:
-                return chunked_reader(fd)
-    except OSError:
-        raise HTTPError(404)
+    return send_file(req, path)
+
+
+def is_dir(path):
+    return os.stat(path)[0] & S_IFMT == S_IFDIR
 
 
-@app.route('/file/(.*)', methods=['DELETE'])
+def make_dirs(path):
+    '''Create path and any missing parent directories.'''
+    parts = path.split('/')
+
+    for i in range(len(parts)):
+        partial = '/'.join(parts[:i + 1])
+        if not partial:
+            continue
+
+        print('* create directory {}'.format(partial))
+        try:
+            os.mkdir(partial)
+        except OSError:
+            pass
+
+
+# Cached file hashes for /file-manifest, mapping path to a
+# (size, mtime, hexdigest) tuple.
+file_hashes = {}
+
+# Hashes that are still being computed, mapping path to a
+# (hasher, offset, size, mtime) tuple, so that we can resume if
+# a manifest request is interrupted.
+partial_hashes = {}
+
+
+def forget_hash(path):
+    '''Invalidate cached hashes for path and anything below it.'''
+    path = path.strip('/')
+    prefix = path + '/'
+
+    for cache in (file_hashes, partial_hashes):
+        for k in [k for k in cache if k == path or k.startswith(prefix)]:
+            del cache[k]
+
+
+def iter_write_file(path, chunks):
+    '''Create or replace a file with content from an iterable of
+    chunks, creating parent directories as necessary.
+
+    This yields an empty chunk after each write, so it can be returned
+    from a request handler to let the server handle other requests
+    while a large file is written.'''
+    if '/' in path:
+        make_dirs(path.rsplit('/', 1)[0])
+
+    forget_hash(path)
+    with open(path, 'wb') as fd:
+        for chunk in chunks:
+            fd.write(chunk)
+            yield b''
+
+
+def remove_file(path):
+    forget_hash(path)
+    os.remove(path)
+
+
+def rename_path(path, newpath):
+    forget_hash(path)
+    forget_hash(newpath)
+    os.rename(path, newpath)
+
+
+@app.route('/file/<path:path>', methods=['DELETE'])
 def del_file(req, path):
     '''Delete a file'''
     print('* request to delete {}'.format(path))
-    try:
-        os.remove(path)
-    except OSError as err:
-        if err.args[0] == errno.ENOENT:
-            raise HTTPError(404)
-        else:
-            raise HTTPError(500)
+    remove_file(path)
 
 
-@app.route('/file/(.*)', methods=['POST'])
+@app.route('/file/<path:path>', methods=['POST'])
 def rename_file(req, path):
     '''Rename a file'''
     newpath = req.text
     print('* request to rename {} -> {}'.format(path, newpath))
-    try:
-        os.rename(path, newpath)
-    except OSError as err:
-        if err.args[0] == errno.ENOENT:
-            raise HTTPError(404)
-        else:
-            raise HTTPError(500)
+    rename_path(path, newpath)
 
 
-@app.route('/file/(.*)', methods=['PUT'])
+@app.route('/file/<path:path>', methods=['PUT'], max_bufsize=16384)
 def put_file(req, path):
     '''Create or replace a file.'''
     print('* request to put {}'.format(path))
-    parts = path.split('/')
+    return iter_write_file(path, req.iter_content())
 
-    for i in range(len(parts) - 1):
-        partial = '/'.join(parts[:i + 1])
-        print('* create directory {}'.format(partial))
+
+def batch_op(req, reader, op):
+    '''Execute a single batch operation, yielding the result line and
+    any file content.'''
+    name = op.get('op')
+    path = op.get('path')
+    result = {'op': name, 'path': path, 'status': 200}
+    content = None
+
+    if name == 'put':
+        data = reader.iter_read(op['size'])
+
+    try:
         try:
-            os.mkdir(partial)
-        except OSError:
-            pass
+            if not isinstance(path, str):
+                raise ValueError('invalid path')
+
+            if name == 'put':
+                yield from iter_write_file(path, data)
+            elif name == 'get':
+                result['size'] = os.stat(path)[6]
+                content = chunked_reader(open(path, 'rb'), buf=req.buffer)
+            elif name == 'stat':
+                s = os.stat(path)
+                result['size'] = s[6]
+                result['is_dir'] = s[0] & S_IFMT == S_IFDIR
+            elif name == 'delete':
+                remove_file(path)
+            elif name == 'rename':
+                if not isinstance(op.get('to'), str):
+                    raise ValueError('invalid "to" path')
+                rename_path(path, op['to'])
+            elif name == 'mkdir':
+                make_dirs(path)
+            else:
+                raise ValueError('unknown operation')
+        except OSError as err:
+            result['status'] = 404 if err.args[0] == errno.ENOENT else 500
+            result['error'] = str(err)
+        except ValueError as err:
+            result['status'] = 400
+            result['error'] = str(err)
+
+        if name == 'put':
+            # Skip any data that a failed put did not consume so that
+            # we can read the next operation.
+            for chunk in data:
+                pass
+    except EOFError:
+        # The request ended in the middle of the file content, so
+        # this is the last operation.
+        result['status'] = 400
+        result['error'] = 'truncated request'
+
+    yield batch_result(result)
+    if content is not None:
+        yield from content
+
+
+def valid_size(size):
+    return isinstance(size, int) and size >= 0
+
+
+def batch_result(result):
+    return (json.dumps(result) + '\n').encode()
+
+
+@app.route('/batch', methods=['POST'], max_bufsize=4096)
+def batch(req):
+    '''Execute a sequence of file operations in a single request.
+
+    The request body contains one operation per line, encoded as a
+    JSON object with "op" and "path" keys. "op" may be one of "get",
+    "put", "stat", "delete", "rename" (with the new path in "to") or
+    "mkdir". A "put" operation has a "size" key, and the line is
+    followed by exactly that many bytes of file content.
+
+    The response contains one JSON result per line, in the same order,
+    with the "op", "path" and HTTP-style "status" of each operation.
+    The result for a successful "get" includes a "size" key, and is
+    followed by that many bytes of file content.
+
+    Operations are read and executed one at a time as the request is
+    streamed, so batches may be arbitrarily large.'''
+    reader = StreamReader(req.iter_content())
+
+    while True:
+        line = reader.readline()
+        if not line:
+            break
+        if not line.strip():
+            continue
 
-    with open(path, 'w') as fd:
-        for chunk in req.iter_content():
-            fd.write(chunk)
+        try:
+            op = json.loads(line)
+        except ValueError:
+            op = None
+
+        # We can't find the start of the next operation if we don't
+        # know how much data follows a put, so give up.
+        if not isinstance(op, dict) or (
+                op.get('op') == 'put' and not valid_size(op.get('size'))):
+            yield batch_result({'status': 400,
+                                'error': 'invalid operation'})
+            break
+
+        print('* batch {} {}'.format(op.get('op'), op.get('path')))
+        yield from batch_op(req, reader, op)
+
+
+def tar_checksum(header):
+    '''Return the checksum of a tar header block, which is computed
+    with the checksum field (8 bytes at offset 148) set to spaces.'''
+    return sum(header[:148]) + 8 * 32 + sum(header[156:])
+
+
+def tar_header(name, size, is_dir):
+    '''Return a 512 byte ustar header block. Names longer than 100
+    bytes are split between the name and prefix fields; raises
+    ValueError if the name can't be stored.'''
+    header = bytearray(512)
+
+    def put(offset, value):
+        header[offset:offset + len(value)] = value
+
+    if is_dir:
+        name = name + '/'
+
+    name = name.encode()
+    if len(name) > 100:
+        # The prefix (up to 155 bytes) and name (up to 100 bytes) are
+        # joined with a "/".
+        i = name.find(b'/', len(name) - 101)
+        if i < 0 or i > 155 or i == len(name) - 1:
+            raise ValueError('name too long')
+        put(345, name[:i])
+        name = name[i + 1:]
+
+    put(0, name)
+    put(100, b'0000755\0' if is_dir else b'0000644\0')
+    put(108, b'0000000\0')
+    put(116, b'0000000\0')
+    put(124, '{:011o}\0'.format(0 if is_dir else size).encode())
+    put(136, b'00000000000\0')
+    put(156, b'5' if is_dir else b'0')
+    put(257, b'ustar\x0000')
+
+    put(148, '{:06o}\0 '.format(tar_checksum(header)).encode())
+
+    return header
+
+
+def walk(path):
+    '''Yield a (path, stat) tuple for everything below path
+    (recursively). An empty path means the root directory.'''
+    for f in (os.listdir(path) if path else os.listdir()):
+        fp = '/'.join([path, f]) if path else f
+        s = os.stat(fp)
+        yield fp, s
+
+        if s[0] & S_IFMT == S_IFDIR:
+            yield from walk(fp)
+
+
+def iter_tar(req, path):
+    '''Yield a tar stream of the directory tree at path. Each file is
+    read in chunks, so this works for trees of any size.'''
+    for fp, s in walk(path):
+        name = fp[len(path) + 1:] if path else fp
+
+        is_dir = s[0] & S_IFMT == S_IFDIR
+        try:
+            header = tar_header(name, s[6], is_dir)
+        except ValueError:
+            print('! not adding {} to tar: name too long'.format(fp))
+            continue
+
+        yield header
+        if not is_dir:
+            yield from chunked_reader(open(fp, 'rb'), buf=req.buffer)
+            if s[6] % 512:
+                yield bytes(512 - s[6] % 512)
+
+    yield bytes(1024)
+
+
+def iter_extract_tar(reader, path, files):
+    '''Extract a tar stream from a StreamReader into path, appending
+    the name of each file that is written to files. Like
+    iter_write_file, this yields an empty chunk after each write.
+
+    Raises EOFError if the stream is truncated, or ValueError if a
+    header is invalid.'''
+    while True:
+        header = reader.read(512)
+        if not any(header):
+            break
+
+        name = header[:100].split(b'\0', 1)[0].decode()
+        prefix = header[345:500].split(b'\0', 1)[0].decode()
+        if prefix:
+            name = '/'.join([prefix, name])
+
+        checksum = int(header[148:156].split(b'\0', 1)[0].strip(), 8)
+        if checksum != tar_checksum(header):
+            raise ValueError('invalid checksum')
+
+        size = int(header[124:136].split(b'\0', 1)[0].strip() or b'0', 8)
+        name = '/'.join([path, name.strip('/')]) if path else name.strip('/')
+
+        if header[156:157] == b'5':
+            make_dirs(name)
+        elif header[156:157] in (b'0', b'\0'):
+            print('* extract {}'.format(name))
+            files.append(name)
+            yield from iter_write_file(name, reader.iter_read(size))
+        else:
+            # Skip links and other special entries.
+            for chunk in reader.iter_read(size):
+                pass
+
+        if size % 512:
+            reader.read(512 - size % 512)
+
+
+def iter_put_tar(req, path):
+    '''Extract the tar archive in the request body into path, then
+    yield the list of extracted files as JSON.'''
+    files = []
+
+    try:
+        yield from iter_extract_tar(StreamReader(req.iter_content()),
+                                    path, files)
+    except EOFError:
+        raise HTTPError(400, content='Truncated tar archive')
+    except ValueError:
+        raise HTTPError(400, content='Invalid tar header')
+
+    yield json.dumps(files).encode()
+
+
+@app.route('/tar/(.*)', cost=5, max_active=1)
+def get_tar(req, path):
+    '''Download the directory tree at path (or everything, if path
+    is empty) as a tar archive.'''
+    path = path.strip('/')
+    if path and not is_dir(path):
+        raise HTTPError(404)
+
+    return Response(content=iter_tar(req, path),
+                    content_type='application/x-tar')
+
+
+@app.route('/tar/(.*)', methods=['PUT'], max_bufsize=16384)
+def put_tar(req, path):
+    '''Extract an uploaded tar archive into path.'''
+    path = path.strip('/')
+    if path:
+        make_dirs(path)
+
+    return Response(content=iter_put_tar(req, path),
+                    content_type='application/json')
+
+
+def iter_hash(path, size, mtime, buf):
+    '''Compute the SHA-256 hash of a file, reading one buffer at a
+    time and yielding after each read so that we don't tie up the
+    server. The result is stored in file_hashes.
+
+    If this is interrupted, progress is kept in partial_hashes and
+    the next call for the same (unchanged) file picks up where it
+    left off. If the file is changed while we are waiting (see
+    forget_hash), this stops without storing a result.'''
+    state = partial_hashes.pop(path, None)
+    if state and state[2:] == (size, mtime):
+        hasher, offset = state[:2]
+    else:
+        hasher, offset = hashlib.sha256(), 0
+
+    with open(path, 'rb') as fd:
+        fd.seek(offset)
+        while True:
+            nb = fd.readinto(buf)
+            if not nb:
+                break
+
+            hasher.update(buf[:nb])
+            offset += nb
+            state = partial_hashes[path] = (hasher, offset, size, mtime)
+            yield
+
+            if partial_hashes.get(path) is not state:
+                return
+
+    partial_hashes.pop(path, None)
+    digest = binascii.hexlify(hasher.digest()).decode('ascii')
+    file_hashes[path] = (size, mtime, digest)
+
+
+def iter_manifest(req, path):
+    '''Yield a JSON object mapping the path of each file below path
+    to its size and SHA-256 hash.'''
+    sep = b'{'
+
+    for fp, s in walk(path):
+        if s[0] & S_IFMT == S_IFDIR:
+            continue
+
+        # Other requests may change the file while we are hashing it,
+        # in which case we start again.
+        while True:
+            size, mtime = s[6], s[8]
+            cached = file_hashes.get(fp)
+            if cached and cached[:2] == (size, mtime):
+                break
+
+            for _ in iter_hash(fp, size, mtime, req.buffer):
+                # Yielding an empty chunk gives the server a chance to
+                # do other work.
+                yield b''
+            s = os.stat(fp)
+
+        yield sep
+        yield json.dumps(fp).encode()
+        yield b':'
+        yield json.dumps({'size': size, 'sha256': cached[2]}).encode()
+        sep = b','
+
+    yield b'}' if sep == b',' else b'{}'
+
+
+@app.route('/file-manifest(/.*)?', cost=5, max_active=1)
+def get_manifest(req, path):
+    '''Return the size and SHA-256 hash of every file (or every file
+    below path). Hashes are cached until the file is changed through
+    this API.'''
+    path = (path or '').strip('/')
+    if path and not is_dir(path):
+        raise HTTPError(404)
+
+    return Response(content=iter_manifest(req, path),
+                    content_type='application/json')
 
 
 @app.route('/reset')
@@ -160,8 +583,9 @@ def reset(req):
     machine.reset()
 
 
-@app.route('/net/([^/]+)(/([^/]+))?')
-def get_net_info(req, iface_name, _, key):
+@app.route('/net/<iface_name>')
+@app.route('/net/<iface_name>/<key>')
+def get_net_info(req, iface_name, key=None):
     '''Get information about a network interface.
 
     "eth0" or "sta" refers to the wireless client interface.
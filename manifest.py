@@ -0,0 +1,8 @@
+# Freeze noggin into MicroPython firmware with:
+#
+#   make -C ports/esp8266 FROZEN_MANIFEST=/path/to/noggin/manifest.py
+#
+# Frozen modules execute from flash, so importing noggin costs almost
+# no heap.
+include('$(PORT_DIR)/boards/manifest.py')
+package('noggin')
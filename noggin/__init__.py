@@ -1 +1,2 @@
 from noggin.app import *  # NOQA
+from noggin.util import *  # NOQA
@@ -1,28 +1,111 @@
-import json
+import gc
 import socket
 
-# monkeypatch the standard socket module when running
-# under cpython.
-if not hasattr(socket.socket, 'readline'):
-    import noggin.compat.socket
-    socket.socket = noggin.compat.socket.mpsocket
-
 try:
     import re
 except ImportError:
     import ure as re
 
 try:
-    # You can save about 1500 bytes by not including
-    # noggin/http.py on your micropython board.
-    from noggin.http import HTTP_ERROR_CODES
+    import select
 except ImportError:
-    HTTP_ERROR_CODES = {}
+    import uselect as select
+
+from noggin.util import ticks_ms, ticks_diff
+
+__all__ = ['HTTPError', 'Response', 'Request', 'Route', 'Listener', 'Noggin',
+           'status_description']
+
+# Loaded on first use by status_description().
+_status_codes = None
+
+
+def status_description(status_code):
+    '''Return the standard description of an HTTP status code.
+
+    The table in noggin.http is only imported the first time this is
+    called. You can save about 1500 bytes by not including
+    noggin/http.py on your micropython board, in which case this
+    returns "Unknown status". When using the single-file bundle,
+    noggin is a module rather than a package, so the table is loaded
+    from a top-level noggin_http module instead.'''
+    global _status_codes
+
+    if _status_codes is None:
+        try:
+            from noggin.http import HTTP_ERROR_CODES
+        except ImportError:
+            try:
+                from noggin_http import HTTP_ERROR_CODES
+            except ImportError:
+                HTTP_ERROR_CODES = {}
+
+        _status_codes = HTTP_ERROR_CODES
+
+    return _status_codes.get(status_code, 'Unknown status')
+
+
+def _install_compat():
+    '''Monkeypatch the standard socket module when running under
+    cpython. This is deferred until we create our first socket.
+
+    The single-file bundle does not include noggin.compat, so it can
+    only serve requests under MicroPython.'''
+    if not hasattr(socket.socket, 'readline'):
+        try:
+            import noggin.compat.socket
+        except ImportError:
+            raise ImportError('noggin.compat.socket is needed to serve '
+                              'requests under CPython; the single-file '
+                              'bundle only supports MicroPython')
+
+        socket.socket = noggin.compat.socket.mpsocket
+
+
+def read_headers(sock, max_headers=None):
+    '''Read header lines (e.g. request headers or chunked trailers)
+    up to and including the terminating blank line, returning a dictionary
+    with lower-case names. Raises HTTPError (400) on a malformed line or
+    if there are more than max_headers lines.'''
+    headers = {}
+    count = 0
+
+    while True:
+        line = sock.readline()
+        if not line or line == b'\r\n':
+            break
+
+        count += 1
+        if max_headers is not None and count > max_headers:
+            raise HTTPError(400, content='Too many header lines')
+
+        try:
+            name, value = line.split(b':', 1)
+        except ValueError:
+            raise HTTPError(400, content='Invalid header line')
+
+        headers[name.strip().lower()] = value.strip()
+
+    return headers
+
+
+def content_length(headers):
+    '''Return the value of the Content-length header (0 if there is
+    none), raising HTTPError (400) if it is not a valid length.'''
+    value = headers.get(b'content-length', b'0').strip()
+    if not value.isdigit():
+        raise HTTPError(400, content='Invalid content length')
+
+    return int(value)
 
 
-def extract_match_groups(match):
+def extract_match_groups(match, count=None):
     '''Return the available match groups of a ure match object
-    as a list'''
+    as a list. If you know how many groups there are, pass count
+    to avoid probing for them.'''
+    if count is not None:
+        return [match.group(i) for i in range(1, count + 1)]
+
     groups = []
     i = 1
     while True:
@@ -35,6 +118,104 @@ def extract_match_groups(match):
     return groups
 
 
+def count_groups(regex):
+    '''Return the number of capturing groups in a regular expression.
+    Groups starting with "(?" don't capture, except for named groups
+    ("(?P<name>...)").'''
+    count = 0
+    escaped = in_class = False
+
+    for i, c in enumerate(regex):
+        if escaped:
+            escaped = False
+        elif c == '\\':
+            escaped = True
+        elif in_class:
+            in_class = c != ']'
+        elif c == '[':
+            in_class = True
+        elif c == '(':
+            if regex[i + 1:i + 2] != '?' or regex[i + 1:i + 4] == '?P<':
+                count += 1
+
+    return count
+
+
+# Converters for route placeholders such as <int:id>, mapping each name
+# to a regular expression and a function that converts the matched
+# string (or None to leave it as a string).
+CONVERTERS = {
+    'str': ('([^/]+)', None),
+    'int': ('([0-9]+)', int),
+    'float': ('([0-9]+\\.[0-9]+)', float),
+    'path': ('(.+)', None),
+}
+
+_REGEX_CHARS = '\\.^$*+?()[]{}|<'
+
+
+def _is_placeholder(spec):
+    return spec and all(c.isalpha() or c.isdigit() or c in '_:'
+                        for c in spec)
+
+
+def compile_pattern(pattern):
+    '''Translate <converter:name> (or <name>) placeholders in a route
+    pattern into regular expression groups.
+
+    Returns a (regex, params) tuple, where params has one entry per
+    group in the regex: None for groups that were already in the
+    pattern, or a (name, convert) tuple for placeholders. Raises
+    ValueError for an unknown converter or a placeholder without a
+    name.'''
+    regex = ''
+    params = []
+    pos = search = 0
+
+    while True:
+        start = pattern.find('<', search)
+        if start < 0:
+            break
+
+        end = pattern.find('>', start)
+        if end < 0:
+            break
+
+        # The name of a named group ("(?P<name>...)") is not a
+        # placeholder.
+        spec = pattern[start + 1:end]
+        if pattern[start - 3:start] == '(?P' or not _is_placeholder(spec):
+            search = start + 1
+            continue
+
+        literal = pattern[pos:start]
+        regex += literal
+        params.extend([None] * count_groups(literal))
+
+        if ':' in spec:
+            converter, name = spec.split(':', 1)
+        else:
+            converter, name = 'str', spec
+
+        if not name or ':' in name:
+            raise ValueError('{}: invalid placeholder <{}>'.format(
+                pattern, spec))
+        if converter not in CONVERTERS:
+            raise ValueError('{}: unknown converter "{}"'.format(
+                pattern, converter))
+
+        expr, convert = CONVERTERS[converter]
+        regex += expr
+        params.append((name, convert))
+        pos = search = end + 1
+
+    literal = pattern[pos:]
+    regex += literal
+    params.extend([None] * count_groups(literal))
+
+    return regex, params
+
+
 class HTTPError(Exception):
     '''Request handlers may raise an HTTPError in order to send
     an HTTP error response to the client.
@@ -43,50 +224,73 @@ class HTTPError(Exception):
     description from noggin.http.HTTP_ERROR_CODES.
     '''
 
-    def __init__(self, status_code, status_text=None, content=None):
+    def __init__(self, status_code, status_text=None, content=None,
+                 headers=None):
         self.status_code = status_code
 
         if status_text is None:
-            status_text = HTTP_ERROR_CODES.get(
-                status_code, "Unknown status")
+            status_text = status_description(status_code)
 
         self.status_text = status_text
         self.content = content
+        self.headers = headers
 
 
 class Response():
     '''Request handler functions can return an instance of this class in
-    order specify custom headers and response codes.'''
+    order specify custom headers and response codes.
+
+    If content is an iterable (such as a generator) rather than a
+    string, you may provide content_length so that the client (and
+    HEAD requests) can be told the size of the response.'''
 
     def __init__(self, status_code=200, status_text=None,
-                 content=None, content_type=None, headers=None):
+                 content=None, content_type=None, headers=None,
+                 content_length=None):
 
         self.status_code = status_code
 
         if status_text is None:
-            status_text = HTTP_ERROR_CODES.get(
-                status_code, "Unknown status")
+            status_text = status_description(status_code)
 
         self.status_text = status_text
         self.content = content
         self.content_type = content_type
         self.headers = headers
+        self.content_length = content_length
 
 
 class Request():
-    '''Request handlers receive a Request object as their first argument.'''
+    '''Request handlers receive a Request object as their first argument.
+
+    The request body is read ``bufsize`` bytes at a time. If
+    ``max_bufsize`` is set, the buffer doubles in size (up to
+    ``max_bufsize``, and no more than a quarter of free memory) each
+    time a read fills it.
+
+    ``reading`` is True while iter_content is part way through the
+    request body, so that the server can avoid giving the request a
+    turn until more of the body has arrived.'''
     bufsize = 256
+    max_bufsize = None
+    reading = False
 
-    def __init__(self, app, method, uri, version, headers, raw):
+    def __init__(self, app, method, uri, version, headers, raw, addr=None,
+                 listener=None):
         self.app = app
         self.method = method.decode('ascii')
         self.uri = uri.decode('ascii')
         self.version = version.decode('ascii')
         self.headers = headers
         self.raw = raw
+        self.addr = addr
+        self.listener = listener
+
+        self.trailers = {}
 
         self._cached = None
-        self._buf = bytearray(self.bufsize)
+        self._route = None
+        self._buf = None
 
     def __str__(self):
         return '<{} {}>'.format(self.method, self.uri)
@@ -100,39 +304,98 @@ class Request():
             self.raw.close()
             self.raw = None
 
+        if self._route:
+            self._route.active -= 1
+            self._route = None
+
         self._cached = None
+        self._buf = None
 
-    def _read_n_bytes(self, want):
-        have = 0
+    @property
+    def buffer(self):
+        '''The buffer used to read the request body. Handlers may reuse
+        this to send a response, e.g. chunked_reader(fd, buf=req.buffer).'''
+        if self._buf is None:
+            self._buf = bytearray(self.bufsize)
 
-        if want == 0:
+        return self._buf
+
+    def _grow_buffer(self):
+        size = len(self._buf)
+        if not self.max_bufsize or size >= self.max_bufsize:
             return
 
-        while True:
-            rsize = min(self.bufsize, want - have)
-            nb = self.raw.readinto(self._buf, rsize)
+        try:
+            limit = gc.mem_free() // 4
+        except AttributeError:
+            limit = self.max_bufsize
+
+        newsize = min(size * 2, self.max_bufsize, limit)
+        if newsize > size:
+            self._buf = None
+            self._buf = bytearray(newsize)
+
+    def _read_n_bytes(self, want, more=False):
+        '''Yield want bytes of the request body. If more is True,
+        the body continues after these bytes.'''
+        have = 0
+
+        while have < want:
+            buf = self.buffer
+            nb = self.raw.readinto(buf, min(len(buf), want - have))
             if not nb:
                 break
-            yield self._buf[:nb]
+
+            self.reading = more or have + nb < want
+            yield buf[:nb]
 
             have += nb
-            if have == want:
-                break
 
-    def _read_chunked(self):
-        while True:
-            length = self.raw.readline().strip()
-            length = int(length, 16)
+            # If the read filled our buffer, data is arriving faster
+            # than we are consuming it.
+            if nb == len(buf):
+                self._grow_buffer()
+
+    def _read_chunk_size(self):
+        line = self.raw.readline()
+        if not line.endswith(b'\n'):
+            raise HTTPError(400, content='Truncated chunked request')
+
+        # Discard any chunk extensions (";name=value"). int() would
+        # also accept a sign or underscores, so check for hex digits
+        # first.
+        size = line.split(b';', 1)[0].strip()
+        if not size or size.lower().strip(b'0123456789abcdef'):
+            raise HTTPError(400, content='Invalid chunk size')
+
+        return int(size, 16)
 
-            yield from self._read_n_bytes(length)
+    def _read_chunked(self):
+        max_chunk = self.app.max_chunk_size
+        max_body = self.app.max_body_size
+        total = 0
 
-            self.raw.readline()
+        while True:
+            length = self._read_chunk_size()
             if length == 0:
                 break
 
+            if max_chunk is not None and length > max_chunk:
+                raise HTTPError(413)
+
+            total += length
+            if max_body is not None and total > max_body:
+                raise HTTPError(413)
+
+            yield from self._read_n_bytes(length, more=True)
+
+            if self.raw.readline() != b'\r\n':
+                raise HTTPError(400, content='Missing chunk terminator')
+
+        self.trailers = read_headers(self.raw, self.app.max_headers)
+
     def _read_simple(self):
-        length = int(self.headers.get(b'content-length', 0))
-        yield from self._read_n_bytes(length)
+        yield from self._read_n_bytes(content_length(self.headers))
 
     def _maybe_send_continue(self):
         if self.headers.get(b'expect') == b'100-continue':
@@ -142,12 +405,16 @@ class Request():
     def iter_content(self):
         self._maybe_send_continue()
 
-        if self.headers.get(b'transfer-encoding') == b'chunked':
-            print('* reading chunked content (iter)')
-            yield from self._read_chunked()
-        else:
-            print('* reading simple content (iter)')
-            yield from self._read_simple()
+        self.reading = True
+        try:
+            if self.headers.get(b'transfer-encoding') == b'chunked':
+                print('* reading chunked content (iter)')
+                yield from self._read_chunked()
+            else:
+                print('* reading simple content (iter)')
+                yield from self._read_simple()
+        finally:
+            self.reading = False
 
     @property
     def content(self):
@@ -163,80 +430,666 @@ class Request():
         return str(self.content, 'utf-8')
 
 
+class Route():
+    '''An entry in the Noggin routing table. You will normally create
+    these using the Noggin.route decorator.
+
+    A request to this route charges ``cost`` tokens to the client's
+    rate limit bucket (if the app has a limiter). If ``max_active`` is
+    not None, requests beyond that many in flight at once are rejected
+    with "503 Service unavailable".
+
+    ``before`` and ``after`` are lists of middleware functions that
+    apply only to this route. They are nested inside the
+    application-wide middleware registered with Noggin.before_request
+    and Noggin.after_response.
+
+    ``bufsize`` and ``max_bufsize`` override the application settings
+    for reading request bodies (see Request).
+
+    If ``listeners`` is not None, the route is only available on
+    listeners with one of the given names (see Noggin.listen).
+
+    Patterns may contain placeholders such as <name>, <int:id> or
+    <path:p> (see CONVERTERS), which are passed to the handler as
+    converted keyword arguments. Other regular expression groups are
+    passed as positional arguments. Patterns without any regular
+    expression syntax are matched with a simple string comparison.'''
+
+    def __init__(self, pattern, methods, func, cost=1, max_active=None,
+                 before=None, after=None, bufsize=None, max_bufsize=None,
+                 listeners=None):
+        self.pattern = pattern
+
+        if any(c in _REGEX_CHARS for c in pattern.rstrip('$')):
+            regex, params = compile_pattern(pattern)
+            self.regex = re.compile(regex)
+            self.static = None
+            self.ngroups = len(params)
+
+            # If there are no placeholders, we can pass the groups
+            # straight through as positional arguments.
+            self.params = params if any(params) else None
+        else:
+            self.regex = None
+            self.static = pattern.rstrip('$')
+            self.ngroups = 0
+            self.params = None
+
+        self.listeners = listeners
+        self.methods = methods
+        self.func = func
+        self.cost = cost
+        self.max_active = max_active
+        self.bufsize = bufsize
+        self.max_bufsize = max_bufsize
+        self.active = 0
+        self.before = before or []
+        self.after = after or []
+
+        # The middleware chain (before, after, on_error) for this route,
+        # computed by Noggin when the route or a middleware is
+        # registered.
+        self.chain = ((), (), ())
+
+    def extract(self, match):
+        '''Return the (args, kwargs) to pass to the handler for a
+        match returned by Noggin.match.'''
+        if self.params is None:
+            if self.ngroups:
+                return extract_match_groups(match, self.ngroups), {}
+            return (), {}
+
+        args = []
+        kwargs = {}
+
+        for i, param in enumerate(self.params):
+            value = match.group(i + 1)
+            if param is None:
+                args.append(value)
+            else:
+                name, convert = param
+                if convert and value is not None:
+                    value = convert(value)
+                kwargs[name] = value
+
+        return args, kwargs
+
+
+class Listener():
+    '''A socket on which Noggin accepts connections. You will normally
+    create these using Noggin.listen.
+
+    If ``path`` is set, this is a Unix domain socket (CPython only).
+    Otherwise we listen for TCP connections on ``host`` and ``port``;
+    a host containing ":" (e.g. "::") is treated as an IPv6 address.
+
+    If ``limiter`` is provided it is used instead of the application
+    limiter for connections to this listener.'''
+
+    def __init__(self, port=80, host='', path=None, backlog=1,
+                 name=None, limiter=None):
+        self.port = port
+        self.host = host
+        self.path = path
+        self.backlog = backlog
+        self.name = name
+        self.limiter = limiter
+        self.socket = None
+
+    def __str__(self):
+        if self.path:
+            return '<Listener {}>'.format(self.path)
+        else:
+            return '<Listener [{}]:{}>'.format(self.host, self.port)
+
+    def open(self):
+        _install_compat()
+
+        if self.path:
+            import os
+            try:
+                mode = os.stat(self.path)[0]
+            except OSError:
+                mode = None
+
+            # Remove a stale socket left by a previous server, but
+            # don't touch anything else.
+            if mode is not None:
+                if mode & 0o170000 != 0o140000:
+                    raise OSError('{}: exists and is not a socket'.format(
+                        self.path))
+                os.remove(self.path)
+
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.socket.bind(self.path)
+        else:
+            if ':' in self.host:
+                family = socket.AF_INET6
+            else:
+                family = socket.AF_INET
+
+            self.socket = socket.socket(family, socket.SOCK_STREAM)
+            self.socket.setsockopt(socket.SOL_SOCKET,
+                                   socket.SO_REUSEADDR, 1)
+            self.socket.bind((self.host, self.port))
+
+        self.socket.listen(self.backlog)
+
+    def accept(self):
+        client, addr = self.socket.accept()
+
+        # Unix domain sockets do not have a useful peer address, so
+        # identify the client by the socket path instead.
+        if self.path:
+            addr = (self.path, 0)
+
+        return client, addr
+
+    def close(self):
+        if self.socket:
+            self.socket.close()
+            self.socket = None
+
+
 class Noggin():
     '''Noggin (n): 1. A small mug or cup. 2. A simple web application
-    framework for MicroPython.'''
-
-    def __init__(self, debug=False):
+    framework for MicroPython.
+
+    If ``limiter`` is provided (see noggin.limits.RateLimiter), it
+    will be used to rate limit requests from each client address.
+
+    Requests with a body larger than ``max_body_size`` bytes, or using
+    chunked transfer encoding with a chunk larger than
+    ``max_chunk_size``, are rejected with "413 Request entity too
+    large". Requests (or chunked trailers) with more than
+    ``max_headers`` header lines are rejected with "400 Bad request".
+
+    Request bodies are read ``bufsize`` bytes at a time. If
+    ``max_bufsize`` is set, the read buffer grows up to that size as
+    long as data is arriving quickly and there is free memory.
+
+    When a request handler returns a generator (or other iterable),
+    serve interleaves it with other requests: each in-flight response
+    runs for up to ``slice_ms`` milliseconds at a time, round-robin.
+    Handlers can yield empty chunks to give other requests a turn when
+    they have nothing to send yet; the response headers are not sent
+    until the first non-empty chunk (or the end of the response), so a
+    handler may still raise HTTPError until then. No new connections
+    are accepted while ``max_tasks`` responses are in flight.
+
+    HEAD requests are answered by GET routes (unless a route handles
+    HEAD explicitly); the handler is called with req.method set to
+    "HEAD" but the response body is never sent. OPTIONS requests are
+    answered from the routing table. If ``cors`` is "*" or a list of
+    allowed origins, OPTIONS responses answer CORS preflight requests
+    and other responses include Access-Control-Allow-Origin.'''
+
+    def __init__(self, debug=False, limiter=None,
+                 max_body_size=None, max_chunk_size=None,
+                 bufsize=Request.bufsize, max_bufsize=None,
+                 slice_ms=20, max_tasks=4, cors=None, max_headers=32):
         self._routes = []
-        self._socket = None
+        self._listeners = []
+        self._poller = None
+        self._probe = None
+        self._by_socket = {}
         self._debug = debug
+        self._limiter = limiter
+
+        self.max_body_size = max_body_size
+        self.max_chunk_size = max_chunk_size
+        self.max_headers = max_headers
+        self.bufsize = bufsize
+        self.max_bufsize = max_bufsize
+        self.slice_ms = slice_ms
+        self.max_tasks = max_tasks
+        self._tasks = []
+
+        self._before = []
+        self._after = []
+        self._errors = []
+        self._chain = ((), (), ())
+
+        self.cors = cors
+        if cors:
+            self.after_response(self._add_cors_headers)
+
+    def listen(self, port=80, host='', path=None, backlog=1, name=None,
+               limiter=None):
+        '''Add a listener (see Listener). Calling serve will accept
+        connections on all of the listeners.'''
+        listener = Listener(port, host, path=path, backlog=backlog,
+                            name=name, limiter=limiter)
+        self._listeners.append(listener)
+        return listener
+
+    def _open_listeners(self):
+        self._poller = select.poll()
+        self._by_socket = {}
+
+        for listener in self._listeners:
+            listener.open()
+            print('* listening on {}'.format(listener))
+            self._poller.register(listener.socket, select.POLLIN)
+
+            # poll() returns socket objects under MicroPython and
+            # file descriptors under CPython.
+            self._by_socket[listener.socket] = listener
+            if hasattr(listener.socket, 'fileno'):
+                self._by_socket[listener.socket.fileno()] = listener
+
+    def _accept_ready(self, timeout=-1):
+        '''Wait up to timeout milliseconds (forever if timeout is
+        negative) for connections, and handle a connection from each
+        listener that has one.'''
+        for sock, event in self._poller.poll(timeout):
+            listener = self._by_socket[sock]
+            client, addr = listener.accept()
 
-    def _create_socket(self, port, backlog):
-        self._socket = socket.socket()
-        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self._socket.bind(('', port))
-        self._socket.listen(backlog)
+            try:
+                task = self._start_client(client, addr, listener)
+                if task:
+                    self._tasks.append(task)
+            except OSError as err:
+                print('! error handling client {}:{}: {}'.format(
+                    addr[0], addr[1], err))
+
+    def _run_tasks(self):
+        '''Give each in-flight streaming response a turn.'''
+        for task in list(self._tasks):
+            try:
+                running = self._step(task, poll=True)
+            except OSError as err:
+                # The client has probably gone away.
+                req = task[0]
+                print('! error handling client {}: {}'.format(
+                    req.addr, err))
+                req.close()
+                running = False
+
+            if not running:
+                self._tasks.remove(task)
+
+    def _waiting(self, req):
+        '''Return True if req is part way through reading the request
+        body and none of the rest has arrived yet, in which case
+        reading it would block.'''
+        if not req.reading:
+            return False
+
+        if self._probe is None:
+            self._probe = select.poll()
+
+        self._probe.register(req.raw, select.POLLIN)
+        try:
+            return not self._probe.poll(0)
+        finally:
+            self._probe.unregister(req.raw)
 
-    def _handle_client(self, client, addr):
-        print('* handling connection from {}:{}'.format(*addr))
+    def _step(self, task, poll=False):
+        '''Send chunks from a streaming response for up to slice_ms
+        milliseconds. Returns False when the response is complete (or
+        has failed), at which point the request has been closed.
 
-        req = client.readline()
-        method, uri, version = (req.split() + [b'HTTP/1.0'])[:3]
-        headers = {}
+        If poll is True, the turn ends early (or is skipped) when the
+        handler is waiting for more of the request body.'''
+        req, resp, content, started = task
+        if poll and self._waiting(req):
+            return True
 
-        while True:
-            line = client.readline()
-            if not line or line == b'\r\n':
-                break
+        start = ticks_ms()
+        done = True
 
-            name, value = line.strip().split(b': ')
-            headers[name.lower()] = value
+        try:
+            for chunk in content:
+                if chunk:
+                    if not started:
+                        self._send_headers(req, resp)
+                        started = task[3] = True
+
+                    req.raw.write(chunk)
+
+                if ticks_diff(ticks_ms(), start) >= self.slice_ms:
+                    done = False
+                    break
+
+                if poll and self._waiting(req):
+                    done = False
+                    break
+            else:
+                if not started:
+                    self._send_headers(req, resp)
+        except Exception as err:
+            # This happens if a streaming response fails (e.g. reads a
+            # request body that turns out to be invalid). If we have
+            # already sent the response headers, all we can do is
+            # close the connection.
+            print('! error sending response: {}'.format(err))
+            if not started:
+                try:
+                    self._send_error(req, err)
+                except Exception as exc:
+                    print('! error sending error response: {}'.format(exc))
+            if self._debug and not isinstance(err, HTTPError):
+                req.close()
+                raise
+
+        if done:
+            req.close()
+
+        return not done
+
+    def _handle_client(self, client, addr, listener=None):
+        '''Handle a request from client, including sending any
+        streaming response, before returning.'''
+        task = self._start_client(client, addr, listener)
+        if task:
+            while self._step(task):
+                pass
+
+    def _start_client(self, client, addr, listener=None):
+        '''Read a request from client and call the request handler.
 
-        reqobj = Request(self, method, uri, version, headers, client)
+        If the handler returned a streaming response, return a task
+        that should be passed to _step until it is complete. Otherwise
+        the response has been sent and we return None.'''
+        print('* handling connection from {}:{}'.format(*addr))
+
+        req = client.readline()
+        method, uri, version = (req.split() + [b'HTTP/1.0'])[:3]
+        try:
+            headers = read_headers(client, self.max_headers)
+        except HTTPError as err:
+            print('! invalid request: {}'.format(err.content))
+            self.send_response(client, err.status_code, err.status_text,
+                               content=err.content)
+            client.close()
+            return None
+
+        reqobj = Request(self, method, uri, version, headers, client, addr,
+                         listener)
         print('* request {}'.format(reqobj))
 
         try:
-            self._handle_request(reqobj)
+            task = self._handle_request(reqobj)
         except Exception as err:
             print('! Exception: {}'.format(err))
             self.send_response(client, 500, 'Exception',
                                content=str(err))
+            reqobj.close()
             raise
-        finally:
+
+        if task is None:
             reqobj.close()
 
-    def _handle_request(self, req):
-        handler, match = self.match(req.uri, req.method)
-        if handler:
-            groups = extract_match_groups(match)
+        return task
 
-            try:
-                ret = handler(req, *groups)
-
-                if isinstance(ret, (dict, list)):
-                    self.send_response(req.raw, 200, 'Okay', json.dumps(ret),
-                                       content_type='application/json')
-                elif isinstance(ret, Response):
-                    self.send_response(req.raw,
-                                       ret.status_code,
-                                       ret.status_text,
-                                       ret.content,
-                                       content_type=ret.content_type,
-                                       headers=ret.headers)
-                else:
-                    self.send_response(req.raw, 200, 'Okay', ret)
-            except HTTPError as err:
-                self.send_response(req.raw, err.status_code, err.status_text,
-                                   content=err.content)
+    def _admit(self, req, route):
+        '''Raise an HTTPError if the request should be rejected.
+
+        This is called before the request handler runs, so the request
+        body has not been read (and no "100 Continue" has been sent).'''
+
+        limiter = self._limiter
+        if req.listener and req.listener.limiter:
+            limiter = req.listener.limiter
+
+        if limiter:
+            retry = limiter.admit(req.addr[0], route.cost)
+            if retry:
+                raise HTTPError(429, headers={'Retry-After': retry})
+
+        if route.max_active is not None and route.active >= route.max_active:
+            raise HTTPError(503, headers={'Retry-After': 1})
+
+        if self.max_body_size is not None:
+            if content_length(req.headers) > self.max_body_size:
+                raise HTTPError(413)
+
+        route.active += 1
+        req._route = route
+
+        req.bufsize = route.bufsize or self.bufsize
+        req.max_bufsize = route.max_bufsize or self.max_bufsize
+
+    def _make_response(self, ret):
+        '''Convert the return value of a request handler (or
+        middleware) into a Response.'''
+
+        if isinstance(ret, Response):
+            return ret
+        elif isinstance(ret, (dict, list)):
+            import json
+            return Response(200, 'Okay', json.dumps(ret),
+                            content_type='application/json')
         else:
+            return Response(200, 'Okay', ret)
+
+    def _cors_origin(self, req):
+        '''Return the value for Access-Control-Allow-Origin, or None if
+        this is not an allowed cross-origin request.'''
+        origin = req.headers.get(b'origin')
+        if not self.cors or origin is None:
+            return None
+
+        origin = origin.decode('ascii')
+        if self.cors == '*':
+            return '*'
+        elif isinstance(self.cors, str):
+            if origin == self.cors:
+                return origin
+        elif origin in self.cors:
+            return origin
+
+    def _add_cors_headers(self, req, resp):
+        origin = self._cors_origin(req)
+        if origin:
+            if resp.headers is None:
+                resp.headers = {}
+            resp.headers['Access-Control-Allow-Origin'] = origin
+            if origin != '*':
+                resp.headers['Vary'] = 'Origin'
+
+    def allowed_methods(self, uri, listener=None):
+        '''Return the methods available for uri (or for any uri, if uri
+        is "*"), including the implicit HEAD and OPTIONS methods.'''
+        methods = []
+
+        for route in self._routes:
+            if route.listeners is not None:
+                if listener is None or listener.name not in route.listeners:
+                    continue
+
+            if uri != '*':
+                if route.static is not None:
+                    if uri != route.static:
+                        continue
+                elif not route.regex.match(uri):
+                    continue
+
+            for method in route.methods:
+                if method not in methods:
+                    methods.append(method)
+
+        if 'GET' in methods and 'HEAD' not in methods:
+            methods.append('HEAD')
+        if methods and 'OPTIONS' not in methods:
+            methods.append('OPTIONS')
+
+        return methods
+
+    def _send_options(self, req):
+        '''Answer an OPTIONS request (including CORS preflight
+        requests) from the routing table.'''
+        methods = self.allowed_methods(req.uri, req.listener)
+        if not methods:
             self.send_response(req.raw, 404, 'Not Found',
                                content='{}: not found'.format(req.uri))
+            return
+
+        allow = ', '.join(methods)
+        headers = {'Allow': allow}
+
+        origin = self._cors_origin(req)
+        if origin and b'access-control-request-method' in req.headers:
+            headers['Access-Control-Allow-Origin'] = origin
+            headers['Access-Control-Allow-Methods'] = allow
+            if origin != '*':
+                headers['Vary'] = 'Origin'
+
+            want = req.headers.get(b'access-control-request-headers')
+            if want:
+                headers['Access-Control-Allow-Headers'] = want.decode(
+                    'ascii')
+
+        self.send_response(req.raw, 204, 'No content', headers=headers,
+                           content_length=0)
+
+    def _send_head(self, req, resp):
+        '''Send the headers for a response to a HEAD request, without
+        the body.'''
+        content = resp.content
+        length = resp.content_length
+
+        if length is None and isinstance(content, (str, bytes, bytearray)):
+            length = len(content)
+        elif hasattr(content, 'close'):
+            # Let generators clean up (e.g. close files) without
+            # producing any content.
+            content.close()
+
+        self.send_response(req.raw,
+                           resp.status_code,
+                           resp.status_text,
+                           content_type=resp.content_type,
+                           headers=resp.headers,
+                           content_length=length)
+
+    def _handle_request(self, req):
+        route, match = self._match(req.uri, req.method, req.listener)
+
+        if not route:
+            if req.method == 'HEAD':
+                route, match = self._match(req.uri, 'GET', req.listener)
+            elif req.method == 'OPTIONS':
+                self._send_options(req)
+                return None
+
+        before, after, errors = route.chain if route else self._chain
+
+        try:
+            if not route:
+                raise HTTPError(404, 'Not Found',
+                                '{}: not found'.format(req.uri))
+
+            self._admit(req, route)
+
+            for func in before:
+                ret = func(req)
+                if ret is not None:
+                    break
+            else:
+                args, kwargs = route.extract(match)
+                ret = route.func(req, *args, **kwargs)
+
+            resp = self._make_response(ret)
+        except Exception as err:
+            resp = self._error_response(req, err, errors)
+
+        resp = self._after_response(req, resp, after, errors)
+
+        if req.method == 'HEAD':
+            self._send_head(req, resp)
+            return None
+
+        content = resp.content
+        if not content or isinstance(content, (str, bytes, bytearray)):
+            self.send_response(req.raw,
+                               resp.status_code,
+                               resp.status_text,
+                               content,
+                               content_type=resp.content_type,
+                               headers=resp.headers,
+                               content_length=resp.content_length)
+            return None
+
+        return [req, resp, iter(content), False]
+
+    def _error_response(self, req, err, errors):
+        '''Return the Response from the first error handler that
+        handles err. If none do, return a Response for an HTTPError or
+        re-raise any other exception. If an error handler raises an
+        exception, return a plain 500 response.'''
+        for func in errors:
+            try:
+                ret = func(req, err)
+            except Exception as exc:
+                print('! error in error handler: {}'.format(exc))
+                return Response(500, 'Exception', str(exc))
+
+            if ret is not None:
+                return self._make_response(ret)
+
+        if not isinstance(err, HTTPError):
+            raise err
+
+        return Response(err.status_code, err.status_text,
+                        err.content, headers=err.headers)
+
+    def _after_response(self, req, resp, after, errors):
+        '''Pass resp through the after_response middleware. If one
+        raises an exception, the error handlers may replace the
+        response (which is sent without running the rest of the
+        after_response middleware); otherwise we send a plain 500.'''
+        try:
+            for func in after:
+                ret = func(req, resp)
+                if ret is not None:
+                    resp = ret
+        except Exception as err:
+            print('! error in after_response: {}'.format(err))
+            try:
+                resp = self._error_response(req, err, errors)
+            except Exception as exc:
+                resp = Response(500, 'Exception', str(exc))
+
+        return resp
+
+    def _send_error(self, req, err):
+        '''Send the response for an exception raised by a streaming
+        response before its headers were sent, using the same error
+        and after_response handlers as _handle_request.'''
+        route = req._route
+        before, after, errors = route.chain if route else self._chain
+
+        try:
+            resp = self._error_response(req, err, errors)
+        except Exception as exc:
+            resp = Response(500, 'Exception', str(exc))
+
+        resp = self._after_response(req, resp, after, errors)
+        self.send_response(req.raw,
+                           resp.status_code,
+                           resp.status_text,
+                           resp.content,
+                           content_type=resp.content_type,
+                           headers=resp.headers,
+                           content_length=resp.content_length)
+
+    def _send_headers(self, req, resp):
+        self.send_response(req.raw,
+                           resp.status_code,
+                           resp.status_text,
+                           content_type=resp.content_type,
+                           headers=resp.headers,
+                           content_length=resp.content_length)
 
     def send_response(self, sock, status_code, status_text,
                       content=None,
                       content_type=None,
-                      headers=None):
+                      headers=None,
+                      content_length=None):
 
         print('* sending reponse {} {}'.format(status_code, status_text))
         lines = []
@@ -249,7 +1102,9 @@ class Noggin():
         if content_type:
             lines.append('Content-type: {}\r\n' .format(content_type))
 
-        if content:
+        if content_length is not None:
+            lines.append('Content-length: {}\r\n' .format(content_length))
+        elif content:
             try:
                 clen = len(content)
                 lines.append('Content-length: {}\r\n' .format(clen))
@@ -270,43 +1125,136 @@ class Noggin():
                 sock.write(content)
             else:
                 for chunk in content:
-                    sock.write(chunk)
+                    # Handlers may yield empty chunks when they have
+                    # nothing to send yet.
+                    if chunk:
+                        sock.write(chunk)
 
     def serve(self, port=80, backlog=1):
+        '''Accept and handle connections until interrupted.
+
+        If no listeners have been added using listen, we listen on
+        the given port on all IPv4 addresses.'''
+        if not self._listeners:
+            self.listen(port, backlog=backlog)
+
         try:
-            self._create_socket(port, backlog)
+            self._open_listeners()
 
             while True:
-                client, addr = self._socket.accept()
+                if len(self._tasks) < self.max_tasks:
+                    self._accept_ready(0 if self._tasks else -1)
 
-                try:
-                    self._handle_client(client, addr)
-                except OSError as err:
-                    print('! error handling client {}:{}: {}'.format(
-                        addr[0], addr[1], err))
+                self._run_tasks()
         finally:
             self.close()
 
-    def route(self, pattern, methods=['GET']):
+    def route(self, pattern, methods=['GET'], cost=1, max_active=None,
+              before=None, after=None, bufsize=None, max_bufsize=None,
+              listeners=None):
         if not pattern.endswith('$'):
             pattern = pattern + '$'
 
         def _(func):
-            self._routes.append((re.compile(pattern), methods, func))
+            route = Route(pattern, methods, func,
+                          cost=cost, max_active=max_active,
+                          before=before, after=after,
+                          bufsize=bufsize, max_bufsize=max_bufsize,
+                          listeners=listeners)
+            route.chain = self._build_chain(route)
+            self._routes.append(route)
             return func
 
         return _
 
-    def match(self, uri, method='GET'):
+    def _build_chain(self, route=None):
+        '''Resolve the middleware that applies to a route (or to
+        requests that do not match any route) so that we don't need to
+        work it out for every request.'''
+        before = self._before
+        after = self._after
+
+        if route:
+            before = before + route.before
+            after = after + route.after
+
+        # after_response middleware runs innermost first.
+        return (tuple(before), tuple(reversed(after)), tuple(self._errors))
+
+    def _rebuild_chains(self):
+        self._chain = self._build_chain()
         for route in self._routes:
-            match = route[0].match(uri)
-            if match:
-                if method in route[1]:
-                    return route[2], match
+            route.chain = self._build_chain(route)
+
+    def before_request(self, func):
+        '''Register a middleware function that will be called as
+        func(req) before every request handler.
+
+        This happens before the request body has been read. If func
+        returns anything other than None, the return value is sent to
+        the client (as if it had been returned by the request handler)
+        and the request handler is not called.'''
+        self._before.append(func)
+        self._rebuild_chains()
+        return func
+
+    def after_response(self, func):
+        '''Register a middleware function that will be called as
+        func(req, response) with the Response that is about to be sent
+        to the client, including error responses. If func returns a
+        Response, that will be sent instead.'''
+        self._after.append(func)
+        self._rebuild_chains()
+        return func
+
+    def on_error(self, func):
+        '''Register a middleware function that will be called as
+        func(req, err) when a request handler or middleware raises an
+        exception (including HTTPError). If func returns anything other
+        than None, the return value is sent to the client instead of
+        the default error response. If func itself raises an exception,
+        a plain "500 Exception" response is sent.'''
+        self._errors.append(func)
+        self._rebuild_chains()
+        return func
+
+    def _match(self, uri, method='GET', listener=None):
+        for route in self._routes:
+            if route.listeners is not None:
+                if listener is None or listener.name not in route.listeners:
+                    continue
+
+            if route.static is not None:
+                if uri != route.static:
+                    continue
+                match = None
+            else:
+                match = route.regex.match(uri)
+                if not match:
+                    continue
+
+            if method in route.methods:
+                return route, match
+
+        return None, None
+
+    def match(self, uri, method='GET'):
+        '''Return the handler for uri and the regular expression
+        match object (which is None for routes that do not use regular
+        expressions), or (None, None) if there is no matching route.'''
+        route, match = self._match(uri, method)
+        if route:
+            return route.func, match
         else:
             return None, None
 
     def close(self):
-        if self._socket:
-            self._socket.close()
-            self._socket = None
+        for task in self._tasks:
+            task[0].close()
+
+        self._tasks = []
+
+        for listener in self._listeners:
+            listener.close()
+
+        self._poller = None
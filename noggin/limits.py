@@ -0,0 +1,80 @@
+'''Admission control for noggin applications.
+
+A RateLimiter passed to Noggin(limiter=...) is consulted before a
+request handler runs (and before any of the request body is read), so
+that misbehaving clients can be rejected cheaply with a "429 Too many
+requests" response.
+'''
+
+from noggin.util import ticks_ms, ticks_diff
+
+__all__ = ['RateLimiter']
+
+
+class RateLimiter():
+    '''Per-client token buckets.
+
+    Each client may make ``rate`` requests every ``period`` seconds,
+    with bursts of up to ``burst`` requests. Routes may charge more
+    than one token per request (see the ``cost`` argument to
+    Noggin.route).
+
+    Clients are tracked in a fixed-size table of ``size`` entries so
+    that memory use does not grow with the number of clients. When the
+    table is full the least recently seen client is forgotten (and
+    will start again with a full bucket).
+    '''
+
+    def __init__(self, rate, period=1, burst=None, size=8):
+        # Token counts are stored as integers in units of 1/period_ms
+        # of a token, so that refilling for every elapsed millisecond
+        # simply adds ``rate`` units.
+        self.rate = rate
+        self.period_ms = period * 1000
+        self.capacity = (burst or rate) * self.period_ms
+
+        self._clients = [None] * size
+        self._tokens = [0] * size
+        self._stamps = [0] * size
+
+    def _slot(self, client, now):
+        oldest = 0
+        for i, c in enumerate(self._clients):
+            if c == client:
+                return i
+            if ticks_diff(self._stamps[oldest], self._stamps[i]) > 0:
+                oldest = i
+            if c is None:
+                oldest = i
+                break
+
+        self._clients[oldest] = client
+        self._tokens[oldest] = self.capacity
+        self._stamps[oldest] = now
+        return oldest
+
+    def admit(self, client, cost=1, now=None):
+        '''Charge ``cost`` tokens to ``client``.
+
+        Returns 0 if the request may proceed, otherwise the number of
+        seconds after which the client may retry.'''
+
+        if now is None:
+            now = ticks_ms()
+
+        i = self._slot(client, now)
+        elapsed = ticks_diff(now, self._stamps[i])
+        if elapsed < 0:
+            elapsed = self.period_ms
+
+        tokens = min(self.capacity, self._tokens[i] + elapsed * self.rate)
+        self._stamps[i] = now
+
+        want = cost * self.period_ms
+        if tokens >= want:
+            self._tokens[i] = tokens - want
+            return 0
+
+        self._tokens[i] = tokens
+        wait_ms = (want - tokens + self.rate - 1) // self.rate
+        return (wait_ms + 999) // 1000
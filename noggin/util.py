@@ -1,8 +1,87 @@
-def chunked_reader(fd, bufsize=256):
-    '''Yield bufsize chunks of a file until we're done'''
-    buf = bytearray(bufsize)
-    while True:
-        nb = fd.readinto(buf)
-        if not nb:
-            break
-        yield buf[:nb]
+try:
+    from time import ticks_ms, ticks_diff
+except ImportError:
+    # CPython doesn't have the MicroPython "ticks" functions. These are
+    # defined here rather than in noggin.compat so that the single-file
+    # bundle (which contains this module) still works under CPython.
+    import time
+
+    def ticks_ms():
+        '''Return a millisecond counter with an arbitrary reference
+        point.'''
+        return int(time.monotonic() * 1000)
+
+    def ticks_diff(ticks1, ticks2):
+        '''Return the signed difference ticks1 - ticks2.'''
+        return ticks1 - ticks2
+
+__all__ = ['chunked_reader', 'StreamReader']
+
+
+def chunked_reader(fd, bufsize=256, buf=None):
+    '''Yield bufsize chunks of a file until we're done, then close the
+    file.
+
+    If buf is provided (e.g. req.buffer), it is used instead of
+    allocating a new buffer.'''
+    if buf is None:
+        buf = bytearray(bufsize)
+
+    try:
+        while True:
+            nb = fd.readinto(buf)
+            if not nb:
+                break
+            yield buf[:nb]
+    finally:
+        fd.close()
+
+
+class StreamReader():
+    '''Read lines and fixed-size blocks from an iterable of byte strings,
+    such as req.iter_content(), without reading the whole stream into
+    memory.'''
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._pending = b''
+
+    def _fill(self):
+        try:
+            self._pending += next(self._chunks)
+        except StopIteration:
+            return False
+
+        return True
+
+    def readline(self, limit=1024):
+        '''Read a line, including the trailing newline. Returns a
+        partial line if the stream ends or the line is longer than
+        limit, and an empty string at the end of the stream.'''
+        while b'\n' not in self._pending and len(self._pending) < limit:
+            if not self._fill():
+                break
+
+        end = self._pending.find(b'\n') + 1
+        if end == 0 or end > limit:
+            end = min(limit, len(self._pending))
+
+        line = self._pending[:end]
+        self._pending = self._pending[end:]
+        return bytes(line)
+
+    def iter_read(self, size):
+        '''Yield chunks totalling size bytes. Raises EOFError if the
+        stream ends first.'''
+        while size > 0:
+            if not self._pending and not self._fill():
+                raise EOFError()
+
+            chunk = self._pending[:size]
+            self._pending = self._pending[len(chunk):]
+            size -= len(chunk)
+            yield chunk
+
+    def read(self, size):
+        '''Read exactly size bytes.'''
+        return b''.join(self.iter_read(size))
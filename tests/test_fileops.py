@@ -0,0 +1,238 @@
+import hashlib
+import io
+import json
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import types
+from unittest import TestCase
+from unittest.mock import patch
+
+EXAMPLES = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'examples')
+
+
+def load_fileops():
+    '''Import the fileops example with stand-ins for the
+    MicroPython-only machine and network modules.'''
+    stubs = {
+        'machine': types.ModuleType('machine'),
+        'network': types.ModuleType('network'),
+    }
+
+    with patch.dict(sys.modules, stubs), patch.object(
+            sys, 'path', [EXAMPLES] + sys.path):
+        sys.modules.pop('fileops', None)
+        import fileops
+
+    sys.modules.pop('fileops', None)
+    fileops.app._limiter = None
+    return fileops
+
+
+class FakeClient():
+    def __init__(self, request):
+        self.rfile = io.BytesIO(request)
+        self.out = bytearray()
+
+    def readline(self):
+        return self.rfile.readline()
+
+    def readinto(self, buf, nbytes=0):
+        return self.rfile.readinto(memoryview(buf)[:nbytes or len(buf)])
+
+    def write(self, buf):
+        self.out.extend(buf)
+        return len(buf)
+
+    def close(self):
+        pass
+
+
+class TestFileops(TestCase):
+    def setUp(self):
+        self.fileops = load_fileops()
+        self.cwd = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        os.chdir(self.tmpdir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def request(self, request):
+        client = FakeClient(request)
+        self.fileops.app._handle_client(client, ('1.2.3.4', 1234))
+        status, _, body = bytes(client.out).partition(b'\r\n\r\n')
+        return status.split(b'\r\n')[0], body
+
+    def test_index(self):
+
+        '''Does / serve help.html?'''
+
+        shutil.copy(os.path.join(EXAMPLES, 'help.html'), 'help.html')
+        with open('help.html', 'rb') as fd:
+            expected = fd.read()
+
+        status, body = self.request(b'GET / HTTP/1.1\r\n\r\n')
+        assert status.startswith(b'HTTP/1.1 200 ')
+        assert body == expected
+
+        status, body = self.request(b'HEAD / HTTP/1.1\r\n\r\n')
+        assert status.startswith(b'HTTP/1.1 200 ')
+        assert body == b''
+
+    def test_batch_invalid(self):
+
+        '''Are invalid batch operations reported as 400 results
+        rather than crashing the server?'''
+
+        body = (b'{"op": "mkdir", "path": "a"}\n'
+                b'{"op": "rename", "path": "a"}\n'
+                b'{"op": "put", "path": "a/b", "size": 100}\n'
+                b'short')
+        status, body = self.request(
+            b'POST /batch HTTP/1.1\r\nContent-length: %d\r\n\r\n%s' % (
+                len(body), body))
+
+        results = [json.loads(line) for line in body.splitlines()]
+        assert [r['status'] for r in results] == [200, 400, 400]
+        assert results[2]['error'] == 'truncated request'
+
+        body = b'{"op": "put", "path": "a/c"}\nxyz'
+        status, body = self.request(
+            b'POST /batch HTTP/1.1\r\nContent-length: %d\r\n\r\n%s' % (
+                len(body), body))
+
+        assert json.loads(body)['status'] == 400
+        assert not os.path.exists('a/c')
+
+    def test_tar_invalid(self):
+
+        '''Are truncated or invalid tar archives (including headers
+        with the wrong checksum) rejected with a 400 error?'''
+
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode='w',
+                          format=tarfile.USTAR_FORMAT) as tar:
+            info = tarfile.TarInfo('file.txt')
+            info.size = 1000
+            tar.addfile(info, io.BytesIO(bytes(1000)))
+
+        truncated = buf.getvalue()[:522]
+        invalid = bytearray(buf.getvalue())
+        invalid[124:136] = b'zzzzzzzzzzz\0'
+        corrupt = bytearray(buf.getvalue())
+        corrupt[0:1] = b'g'
+
+        for data in (truncated, bytes(invalid), bytes(corrupt)):
+            status, body = self.request(
+                b'PUT /tar/x HTTP/1.1\r\nContent-length: %d\r\n\r\n%s' % (
+                    len(data), data))
+            assert status == b'HTTP/1.1 400 Bad request'
+
+        status, body = self.request(
+            b'PUT /tar/x HTTP/1.1\r\nContent-length: %d\r\n\r\n%s' % (
+                len(buf.getvalue()), buf.getvalue()))
+        assert status.startswith(b'HTTP/1.1 200 ')
+        assert json.loads(body) == ['x/file.txt']
+        assert os.path.getsize('x/file.txt') == 1000
+
+    def test_hash_invalidated(self):
+
+        '''Is a hash that was running while its file was rewritten
+        discarded rather than stored?'''
+
+        fileops = self.fileops
+        with open('big', 'wb') as fd:
+            fd.write(b'a' * 1000)
+
+        s = os.stat('big')
+        hasher = fileops.iter_hash('big', s[6], s[8], bytearray(256))
+        next(hasher)
+
+        for _ in fileops.iter_write_file('big', [b'b' * 1000]):
+            pass
+
+        for _ in hasher:
+            pass
+
+        assert 'big' not in fileops.file_hashes
+
+        status, body = self.request(b'GET /file-manifest HTTP/1.1\r\n\r\n')
+        expected = hashlib.sha256(b'b' * 1000).hexdigest()
+        assert json.loads(body)['big']['sha256'] == expected
+
+    def test_tar_long_names(self):
+
+        '''Are names longer than 100 bytes stored using the ustar
+        prefix field, and names that are too long left out?'''
+
+        long_dir = '/'.join(['d' * 60, 'e' * 60])
+        os.makedirs(os.path.join('src', long_dir))
+        with open(os.path.join('src', long_dir, 'f' * 90), 'wb') as fd:
+            fd.write(b'long')
+        with open(os.path.join('src', long_dir, 'g' * 150), 'wb') as fd:
+            fd.write(b'too long')
+
+        status, body = self.request(b'GET /tar/src HTTP/1.1\r\n\r\n')
+        tar = tarfile.open(fileobj=io.BytesIO(body))
+        name = '/'.join([long_dir, 'f' * 90])
+        assert tar.getnames() == ['d' * 60, long_dir, name]
+        assert tar.extractfile(name).read() == b'long'
+
+    def test_batch(self):
+
+        '''Is file content framed as described: put data follows its
+        operation, and get content follows its result line?'''
+
+        body = (b'{"op": "put", "path": "a/b", "size": 5}\n'
+                b'hello'
+                b'{"op": "get", "path": "a/b"}\n'
+                b'{"op": "stat", "path": "a"}\n')
+        status, body = self.request(
+            b'POST /batch HTTP/1.1\r\nContent-length: %d\r\n\r\n%s' % (
+                len(body), body))
+        assert status.startswith(b'HTTP/1.1 200 ')
+
+        reader = io.BytesIO(body)
+        put = json.loads(reader.readline())
+        assert (put['op'], put['status']) == ('put', 200)
+
+        get = json.loads(reader.readline())
+        assert (get['op'], get['status'], get['size']) == ('get', 200, 5)
+        assert reader.read(get['size']) == b'hello'
+
+        stat = json.loads(reader.readline())
+        assert (stat['status'], stat['is_dir']) == (200, True)
+        assert reader.read() == b''
+
+    def test_tar(self):
+
+        '''Can tarfile read the archive from GET /tar, and can we
+        extract it again with PUT /tar?'''
+
+        os.makedirs('src/sub')
+        files = {'src/a.txt': b'a' * 700, 'src/sub/b.txt': b'b'}
+        for name, data in files.items():
+            with open(name, 'wb') as fd:
+                fd.write(data)
+
+        status, body = self.request(b'GET /tar/src HTTP/1.1\r\n\r\n')
+        assert status.startswith(b'HTTP/1.1 200 ')
+
+        tar = tarfile.open(fileobj=io.BytesIO(body))
+        assert sorted(tar.getnames()) == ['a.txt', 'sub', 'sub/b.txt']
+        assert tar.getmember('sub').isdir()
+        for name, data in files.items():
+            assert tar.extractfile(name[4:]).read() == data
+
+        status, body = self.request(
+            b'PUT /tar/dst HTTP/1.1\r\nContent-length: %d\r\n\r\n%s' % (
+                len(body), body))
+        assert sorted(json.loads(body)) == ['dst/a.txt', 'dst/sub/b.txt']
+        for name, data in files.items():
+            with open('dst' + name[3:], 'rb') as fd:
+                assert fd.read() == data
@@ -0,0 +1,56 @@
+from unittest import TestCase
+
+from noggin.limits import RateLimiter
+
+
+class TestRateLimiter(TestCase):
+    def test_burst(self):
+
+        '''Can a client make up to burst requests at once, and is the
+        next one rejected?'''
+
+        limiter = RateLimiter(rate=1, burst=3)
+        for i in range(3):
+            assert limiter.admit('1.2.3.4', now=0) == 0
+        assert limiter.admit('1.2.3.4', now=0) == 1
+
+    def test_refill(self):
+
+        '''Are tokens replenished over time?'''
+
+        limiter = RateLimiter(rate=2, period=1, burst=1)
+        assert limiter.admit('1.2.3.4', now=0) == 0
+        assert limiter.admit('1.2.3.4', now=100) == 1
+        assert limiter.admit('1.2.3.4', now=600) == 0
+
+    def test_cost(self):
+
+        '''Do expensive requests consume more tokens, and is the retry
+        delay computed accordingly?'''
+
+        limiter = RateLimiter(rate=1, period=1, burst=5)
+        assert limiter.admit('1.2.3.4', cost=5, now=0) == 0
+        assert limiter.admit('1.2.3.4', cost=5, now=1000) == 4
+
+    def test_clients_independent(self):
+
+        '''Does one client exhausting its bucket leave other clients
+        alone?'''
+
+        limiter = RateLimiter(rate=1, burst=1)
+        assert limiter.admit('1.2.3.4', now=0) == 0
+        assert limiter.admit('1.2.3.4', now=0) == 1
+        assert limiter.admit('5.6.7.8', now=0) == 0
+
+    def test_fixed_size(self):
+
+        '''Is the client table bounded, evicting the least recently seen
+        client?'''
+
+        limiter = RateLimiter(rate=1, burst=1, size=2)
+        assert limiter.admit('a', now=0) == 0
+        assert limiter.admit('b', now=10) == 0
+        assert limiter.admit('c', now=20) == 0
+        assert len(limiter._clients) == 2
+        assert 'a' not in limiter._clients
+        assert limiter.admit('b', now=20) == 1
@@ -1,7 +1,16 @@
+import errno
+import io
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import types
 from unittest import TestCase
 from unittest.mock import MagicMock, patch
 
 import noggin
+from noggin.limits import RateLimiter
 
 
 def fake_recv_into(self, buf, buflen=0, flags=0):
@@ -47,6 +56,88 @@ class TestNoggin(TestCase):
         handler, match = self.app.match('/path2/foo/bar')
         assert handler is None
 
+    def test_route_static(self, mock_recv, mock_send):
+
+        '''Are routes without regular expressions matched exactly?'''
+
+        self.app.route('/path1')(MagicMock())
+        route = self.app._routes[0]
+        assert route.static == '/path1'
+        assert route.regex is None
+        assert self.app.match('/path1')[0]
+        assert self.app.match('/path1/')[0] is None
+        assert self.app.match('/path')[0] is None
+
+    def test_route_placeholders(self, mock_recv, mock_send):
+
+        '''Are typed placeholders converted and passed as keyword
+        arguments, alongside positional regular expression groups?'''
+
+        handler = MagicMock(return_value='ok')
+        self.app.route('/dev/([a-z]+)/<int:id>/<name>/<path:rest>')(handler)
+
+        mock_recv.side_effect = (bytes([b]) for b in
+                                 b'GET /dev/sensor/42/temp/a/b.txt\r\n\r\n')
+        client = noggin.compat.socket.mpsocket()
+        self.app._handle_client(client, ('1.2.3.4.', 1234))
+
+        args, kwargs = handler.call_args
+        assert args[1:] == ('sensor',)
+        assert kwargs == {'id': 42, 'name': 'temp', 'rest': 'a/b.txt'}
+
+    def test_route_placeholder_types(self, mock_recv, mock_send):
+
+        '''Do typed placeholders only match values of their type?'''
+
+        self.app.route('/item/<int:id>')(MagicMock())
+        self.app.route('/price/<float:value>')(MagicMock())
+
+        assert self.app.match('/item/12')[0]
+        assert self.app.match('/item/abc')[0] is None
+        assert self.app.match('/price/1.50')[0]
+        assert self.app.match('/price/1')[0] is None
+
+    def test_count_groups(self, mock_recv, mock_send):
+
+        '''Do we count only capturing groups?'''
+
+        assert noggin.app.count_groups('/a/([^/]+)(/(.*))?') == 3
+        assert noggin.app.count_groups(r'/a\(b[(]c(d)') == 1
+        assert noggin.app.count_groups('/a/(?P<x>[0-9]+)(?:b)') == 1
+
+    def test_route_invalid_placeholders(self, mock_recv, mock_send):
+
+        '''Are unknown converters and placeholders without a name
+        rejected when the route is registered?'''
+
+        for pattern in ('/a/<uuid:id>', '/a/<int:>', '/a/<:id>'):
+            with self.assertRaises(ValueError) as cm:
+                self.app.route(pattern)(MagicMock())
+            assert pattern in str(cm.exception)
+
+        with self.assertRaises(ValueError) as cm:
+            noggin.app.compile_pattern('/a/<uuid:id>')
+        assert 'uuid' in str(cm.exception)
+
+    def test_route_named_groups(self, mock_recv, mock_send):
+
+        '''Are named groups left alone (not treated as placeholders)
+        and passed to the handler along with placeholders?'''
+
+        handler = MagicMock(return_value='ok')
+        self.app.route('/a/(?P<x>[0-9]+)/<int:id>')(handler)
+
+        route = self.app._routes[0]
+        assert route.regex.pattern == '/a/(?P<x>[0-9]+)/([0-9]+)$'
+
+        mock_recv.side_effect = (bytes([b]) for b in
+                                 b'GET /a/12/34\r\n\r\n')
+        client = noggin.compat.socket.mpsocket()
+        self.app._handle_client(client, ('1.2.3.4.', 1234))
+
+        assert handler.call_args[0][1:] == ('12',)
+        assert handler.call_args[1] == {'id': 34}
+
     def test_send_response(self, mock_recv, mock_send):
 
         '''Does calling send_response generate the expected
@@ -161,3 +252,800 @@ class TestNoggin(TestCase):
                 b'HTTP/1.1 200 Okay\r\n')
         assert (mock_send.call_args_list[-1][0][0] ==
                 b'This is a test')
+
+    def test_status_description(self, mock_recv, mock_send):
+
+        '''Is the status text table loaded when we need a default
+        description?'''
+
+        assert noggin.status_description(404) == 'Not found'
+        assert noggin.status_description(999) == 'Unknown status'
+        assert noggin.HTTPError(418).status_text == 'I am a teapot'
+
+    def test_status_description_bundle(self, mock_recv, mock_send):
+
+        '''Is the status text table loaded from noggin_http when
+        noggin.http is not available (as with the bundle)?'''
+
+        noggin_http = types.ModuleType('noggin_http')
+        noggin_http.HTTP_ERROR_CODES = {404: 'Missing'}
+
+        with patch.dict(sys.modules, {'noggin.http': None,
+                                      'noggin_http': noggin_http}), \
+                patch('noggin.app._status_codes', None):
+            assert noggin.status_description(404) == 'Missing'
+
+    def test_rate_limit(self, mock_recv, mock_send):
+
+        '''Are clients that exceed their rate limit rejected with
+        a 429 response and a Retry-After header, without running the
+        handler?'''
+
+        self.app = noggin.Noggin(limiter=RateLimiter(rate=1))
+        handler = MagicMock(return_value='This is a test')
+        self.app.route('/')(handler)
+
+        for i in range(2):
+            mock_recv.side_effect = (bytes([b]) for b in
+                                     b'GET /\r\n\r\n')
+            client = noggin.compat.socket.mpsocket()
+            self.app._handle_client(client, ('1.2.3.4', 1234))
+
+        assert handler.call_count == 1
+        assert (mock_send.call_args_list[-3][0][0] ==
+                b'HTTP/1.1 429 Too many requests\r\n')
+        assert (mock_send.call_args_list[-2][0][0] ==
+                b'Retry-After: 1\r\n')
+
+    def test_max_active(self, mock_recv, mock_send):
+
+        '''Are requests beyond a route's concurrency limit rejected
+        with a 503 response?'''
+
+        handler = MagicMock(return_value='This is a test')
+        self.app.route('/', max_active=1)(handler)
+        route = self.app._routes[0]
+        route.active = 1
+
+        mock_recv.side_effect = (bytes([b]) for b in
+                                 b'GET /\r\n\r\n')
+        client = noggin.compat.socket.mpsocket()
+        self.app._handle_client(client, ('1.2.3.4', 1234))
+
+        assert not handler.called
+        assert (mock_send.call_args_list[0][0][0] ==
+                b'HTTP/1.1 503 Service unavailable\r\n')
+        assert route.active == 1
+
+    def test_before_request_short_circuit(self, mock_recv, mock_send):
+
+        '''Can before_request middleware answer a request without
+        calling the handler or reading the body?'''
+
+        handler = MagicMock(return_value='This is a test')
+        self.app.route('/', methods=['PUT'])(handler)
+
+        @self.app.before_request
+        def deny(req):
+            return noggin.Response(403, content='Go away')
+
+        mock_recv.side_effect = [
+            bytes([b]) for b in
+            b'PUT /\r\n'
+            b'Content-length: 15\r\n'
+            b'\r\n'
+            b'This is a test'] + [None]
+        client = noggin.compat.socket.mpsocket()
+        self.app._handle_client(client, ('1.2.3.4.', 1234))
+
+        assert not handler.called
+        assert (mock_send.call_args_list[0][0][0] ==
+                b'HTTP/1.1 403 Forbidden\r\n')
+        assert mock_send.call_args_list[-1][0][0] == b'Go away'
+        assert client.recv(1) == b'T'
+
+    def test_after_response(self, mock_recv, mock_send):
+
+        '''Does after_response middleware see (and modify) every
+        response, in the expected order?'''
+
+        calls = []
+
+        def route_after(req, resp):
+            calls.append('route')
+
+        self.app.route('/', after=[route_after])(
+            MagicMock(return_value='This is a test'))
+
+        @self.app.after_response
+        def add_header(req, resp):
+            calls.append('app')
+            resp.headers = {'X-Test': 'yes'}
+
+        mock_recv.side_effect = (bytes([b]) for b in
+                                 b'GET /\r\n\r\n')
+        client = noggin.compat.socket.mpsocket()
+        self.app._handle_client(client, ('1.2.3.4.', 1234))
+
+        assert calls == ['route', 'app']
+        assert (mock_send.call_args_list[1][0][0] ==
+                b'X-Test: yes\r\n')
+
+    def test_on_error(self, mock_recv, mock_send):
+
+        '''Can on_error middleware replace the response for an
+        exception raised by a handler?'''
+
+        self.app.route('/')(MagicMock(side_effect=OSError(2)))
+
+        @self.app.on_error
+        def handle_oserror(req, err):
+            if isinstance(err, OSError):
+                return noggin.Response(404, content='missing')
+
+        mock_recv.side_effect = (bytes([b]) for b in
+                                 b'GET /\r\n\r\n')
+        client = noggin.compat.socket.mpsocket()
+        self.app._handle_client(client, ('1.2.3.4.', 1234))
+
+        assert (mock_send.call_args_list[0][0][0] ==
+                b'HTTP/1.1 404 Not found\r\n')
+        assert mock_send.call_args_list[-1][0][0] == b'missing'
+
+    def test_middleware_errors(self, mock_recv, mock_send):
+
+        '''Are exceptions raised by after_response middleware passed
+        to on_error, and do exceptions raised by on_error handlers
+        result in a 500 response rather than stopping the server?'''
+
+        errors = []
+
+        @self.app.route('/')
+        def handler(req):
+            return 'This is a test'
+
+        @self.app.after_response
+        def broken(req, resp):
+            raise ValueError('broken')
+
+        @self.app.on_error
+        def handle_error(req, err):
+            errors.append(err)
+            if req.uri == '/':
+                return noggin.Response(418, content='handled')
+            raise KeyError('also broken')
+
+        for uri, status in ((b'/', b'418 I am a teapot'),
+                            (b'/missing', b'500 Exception')):
+            mock_send.reset_mock()
+            mock_recv.side_effect = (bytes([b]) for b in
+                                     b'GET ' + uri + b'\r\n\r\n')
+            client = noggin.compat.socket.mpsocket()
+            self.app._handle_client(client, ('1.2.3.4.', 1234))
+
+            assert (mock_send.call_args_list[0][0][0] ==
+                    b'HTTP/1.1 ' + status + b'\r\n')
+
+        assert isinstance(errors[0], ValueError)
+
+    def test_middleware_chain_precomputed(self, mock_recv, mock_send):
+
+        '''Are middleware chains resolved when routes and middleware
+        are registered, regardless of the order of registration?'''
+
+        def app_before(req):
+            pass
+
+        def route_before(req):
+            pass
+
+        self.app.route('/', before=[route_before])(MagicMock())
+        self.app.before_request(app_before)
+        route = self.app._routes[0]
+
+        assert route.chain[0] == (app_before, route_before)
+        assert self.app._chain[0] == (app_before,)
+
+    def test_read_chunked_extensions_trailers(self, mock_recv, mock_send):
+
+        '''Are chunk extensions ignored and trailers made available
+        to the handler?'''
+
+        trailers = {}
+
+        @self.app.route('/', methods=['PUT'])
+        def handler(req):
+            content = req.content
+            trailers.update(req.trailers)
+            return content
+
+        mock_recv.side_effect = [
+            bytes([b]) for b in
+            b'PUT /\r\n'
+            b'Transfer-encoding: chunked\r\n'
+            b'\r\n'
+            b'8;name=value\r\n'
+            b'This is \r\n'
+            b'6\r\n'
+            b'a test\r\n'
+            b'0\r\n'
+            b'X-Checksum: 1234\r\n'
+            b'\r\n'] + [None]
+        client = noggin.compat.socket.mpsocket()
+        self.app._handle_client(client, ('1.2.3.4.', 1234))
+
+        assert (mock_send.call_args_list[0][0][0] ==
+                b'HTTP/1.1 200 Okay\r\n')
+        assert (mock_send.call_args_list[-1][0][0] ==
+                b'This is a test')
+        assert trailers == {b'x-checksum': b'1234'}
+
+    def test_read_chunked_too_large(self, mock_recv, mock_send):
+
+        '''Are chunks larger than max_chunk_size rejected without
+        reading them?'''
+
+        self.app = noggin.Noggin(max_chunk_size=8)
+
+        @self.app.route('/', methods=['PUT'])
+        def handler(req):
+            return req.content
+
+        mock_recv.side_effect = [
+            bytes([b]) for b in
+            b'PUT /\r\n'
+            b'Transfer-encoding: chunked\r\n'
+            b'\r\n'
+            b'E\r\n'
+            b'This is a test'
+            b'\r\n'
+            b'0\r\n'
+            b'\r\n'] + [None]
+        client = noggin.compat.socket.mpsocket()
+        self.app._handle_client(client, ('1.2.3.4.', 1234))
+
+        assert (mock_send.call_args_list[0][0][0] ==
+                b'HTTP/1.1 413 Request entity too large\r\n')
+        assert client.recv(1) == b'T'
+
+    def test_read_chunked_invalid(self, mock_recv, mock_send):
+
+        '''Is an invalid chunk size rejected with a 400 error?'''
+
+        @self.app.route('/', methods=['PUT'])
+        def handler(req):
+            return req.content
+
+        mock_recv.side_effect = [
+            bytes([b]) for b in
+            b'PUT /\r\n'
+            b'Transfer-encoding: chunked\r\n'
+            b'\r\n'
+            b'XYZ\r\n'] + [None]
+        client = noggin.compat.socket.mpsocket()
+        self.app._handle_client(client, ('1.2.3.4.', 1234))
+
+        assert (mock_send.call_args_list[0][0][0] ==
+                b'HTTP/1.1 400 Bad request\r\n')
+
+    def test_read_chunked_signed_size(self, mock_recv, mock_send):
+
+        '''Are chunk sizes that int() would accept but that are not
+        plain hex digits (e.g. negative sizes, which would otherwise
+        get around max_body_size) rejected?'''
+
+        self.app = noggin.Noggin(max_body_size=10)
+        handler = MagicMock(side_effect=lambda req: req.content)
+        self.app.route('/', methods=['PUT'])(handler)
+
+        for size in (b'-100', b'+a', b'1_0', b''):
+            mock_send.reset_mock()
+            mock_recv.side_effect = [
+                bytes([b]) for b in
+                b'PUT /\r\n'
+                b'Transfer-encoding: chunked\r\n'
+                b'\r\n' +
+                size + b'\r\n'
+                b'\r\n'
+                b'50\r\n' +
+                b'x' * 80 + b'\r\n'
+                b'0\r\n'
+                b'\r\n'] + [None]
+            client = noggin.compat.socket.mpsocket()
+            self.app._handle_client(client, ('1.2.3.4.', 1234))
+
+            assert (mock_send.call_args_list[0][0][0] ==
+                    b'HTTP/1.1 400 Bad request\r\n')
+
+    def test_invalid_headers(self, mock_recv, mock_send):
+
+        '''Are malformed headers, an invalid content-length and too
+        many trailers rejected with a 400 error?'''
+
+        self.app = noggin.Noggin(max_body_size=100, max_headers=4)
+
+        @self.app.route('/', methods=['PUT'])
+        def handler(req):
+            return req.content
+
+        requests = [
+            b'PUT /\r\nContent-length: abc\r\n\r\n',
+            b'PUT /\r\nContent-length: -1\r\n\r\n',
+            b'PUT /\r\nNo colon here\r\n\r\n',
+            b'PUT /\r\n' + b'X-Header: 1\r\n' * 5 + b'\r\n',
+            b'PUT /\r\nTransfer-encoding: chunked\r\n\r\n'
+            b'0\r\nNo colon here\r\n\r\n',
+            b'PUT /\r\nTransfer-encoding: chunked\r\n\r\n'
+            b'0\r\n' + b'X-Trailer: 1\r\n' * 5 + b'\r\n',
+        ]
+
+        for request in requests:
+            mock_send.reset_mock()
+            mock_recv.side_effect = [bytes([b]) for b in request] + [None]
+            client = noggin.compat.socket.mpsocket()
+            self.app._handle_client(client, ('1.2.3.4.', 1234))
+
+            assert (mock_send.call_args_list[0][0][0] ==
+                    b'HTTP/1.1 400 Bad request\r\n')
+
+    def test_content_length_too_large(self, mock_recv, mock_send):
+
+        '''Are requests with a content-length larger than max_body_size
+        rejected before calling the handler?'''
+
+        self.app = noggin.Noggin(max_body_size=8)
+        handler = MagicMock()
+        self.app.route('/', methods=['PUT'])(handler)
+
+        mock_recv.side_effect = [
+            bytes([b]) for b in
+            b'PUT /\r\n'
+            b'Content-length: 15\r\n'
+            b'Expect: 100-continue\r\n'
+            b'\r\n'
+            b'This is a test'] + [None]
+        client = noggin.compat.socket.mpsocket()
+        self.app._handle_client(client, ('1.2.3.4.', 1234))
+
+        assert not handler.called
+        assert (mock_send.call_args_list[0][0][0] ==
+                b'HTTP/1.1 413 Request entity too large\r\n')
+
+    def test_route_bufsize(self, mock_recv, mock_send):
+
+        '''Does a route's bufsize override the application default?'''
+
+        self.app = noggin.Noggin(bufsize=64)
+        sizes = []
+
+        @self.app.route('/', methods=['PUT'], bufsize=128)
+        def handler(req):
+            sizes.append(len(req.buffer))
+
+        mock_recv.side_effect = (bytes([b]) for b in
+                                 b'PUT /\r\n\r\n')
+        client = noggin.compat.socket.mpsocket()
+        self.app._handle_client(client, ('1.2.3.4.', 1234))
+
+        assert sizes == [128]
+
+    def test_adaptive_bufsize(self, mock_recv, mock_send):
+
+        '''Does the request buffer grow (up to max_bufsize) when reads
+        fill it?'''
+
+        raw = MagicMock()
+        raw.readinto.side_effect = lambda buf, n: n
+        req = noggin.Request(self.app, b'PUT', b'/', b'HTTP/1.1',
+                             {b'content-length': b'4096'}, raw)
+        req.bufsize = 256
+        req.max_bufsize = 1024
+
+        sizes = [len(chunk) for chunk in req.iter_content()]
+
+        assert sizes == [256, 512, 1024, 1024, 1024, 256]
+        assert len(req.buffer) == 1024
+
+    def test_empty_chunks(self, mock_recv, mock_send):
+
+        '''Are empty chunks yielded by a handler skipped rather than
+        written to the client?'''
+
+        @self.app.route('/')
+        def handler(req):
+            yield b''
+            yield b'This is a test'
+            yield b''
+
+        mock_recv.side_effect = (bytes([b]) for b in
+                                 b'GET /\r\n\r\n')
+        client = noggin.compat.socket.mpsocket()
+        self.app._handle_client(client, '1.2.3.4.')
+
+        assert (mock_send.call_args_list[-1][0][0] ==
+                b'This is a test')
+        assert b'' not in [c[0][0] for c in mock_send.call_args_list]
+
+    def test_head(self, mock_recv, mock_send):
+
+        '''Are HEAD requests answered by GET routes, with the
+        content length but without the body?'''
+
+        closed = []
+
+        def content():
+            try:
+                yield b'This is a test'
+            finally:
+                closed.append(True)
+
+        @self.app.route('/')
+        def handler(req):
+            return 'This is a test'
+
+        @self.app.route('/stream')
+        def stream(req):
+            gen = content()
+            next(gen)
+            return noggin.Response(content=gen, content_length=14)
+
+        for uri in (b'/', b'/stream'):
+            mock_send.reset_mock()
+            mock_recv.side_effect = (bytes([b]) for b in
+                                     b'HEAD ' + uri + b'\r\n\r\n')
+            client = noggin.compat.socket.mpsocket()
+            self.app._handle_client(client, '1.2.3.4.')
+
+            sent = [c[0][0] for c in mock_send.call_args_list]
+            assert sent[0].startswith(b'HTTP/1.1 200 ')
+            assert b'Content-length: 14\r\n' in sent
+            assert b'This is a test' not in sent
+
+        assert closed == [True]
+
+    def test_options(self, mock_recv, mock_send):
+
+        '''Are OPTIONS requests answered from the routing table?'''
+
+        handler = MagicMock()
+        self.app.route('/item/<int:id>')(handler)
+        self.app.route('/item/<int:id>', methods=['PUT', 'DELETE'])(handler)
+
+        assert (self.app.allowed_methods('/item/1') ==
+                ['GET', 'PUT', 'DELETE', 'HEAD', 'OPTIONS'])
+        assert self.app.allowed_methods('/item/x') == []
+
+        mock_recv.side_effect = (bytes([b]) for b in
+                                 b'OPTIONS /item/1\r\n\r\n')
+        client = noggin.compat.socket.mpsocket()
+        self.app._handle_client(client, '1.2.3.4.')
+
+        sent = [c[0][0] for c in mock_send.call_args_list]
+        assert sent[0] == b'HTTP/1.1 204 No content\r\n'
+        assert b'Allow: GET, PUT, DELETE, HEAD, OPTIONS\r\n' in sent
+        assert not handler.called
+
+    def test_cors_preflight(self, mock_recv, mock_send):
+
+        '''Are CORS preflight requests answered for allowed origins,
+        and do responses carry Access-Control-Allow-Origin?'''
+
+        self.app = noggin.Noggin(cors=['http://example.com'])
+
+        @self.app.route('/', methods=['GET', 'POST'])
+        def handler(req):
+            return 'This is a test'
+
+        for origin in (b'http://example.com', b'http://example.org'):
+            mock_send.reset_mock()
+            mock_recv.side_effect = (bytes([b]) for b in
+                                     b'OPTIONS /\r\n'
+                                     b'Origin: ' + origin + b'\r\n'
+                                     b'Access-Control-Request-Method: POST\r\n'
+                                     b'Access-Control-Request-Headers: '
+                                     b'content-type\r\n'
+                                     b'\r\n')
+            client = noggin.compat.socket.mpsocket()
+            self.app._handle_client(client, '1.2.3.4.')
+
+            sent = [c[0][0] for c in mock_send.call_args_list]
+            allowed = (b'Access-Control-Allow-Origin: ' + origin + b'\r\n'
+                       in sent)
+            assert allowed == (origin == b'http://example.com')
+            assert (b'Access-Control-Allow-Headers: content-type\r\n'
+                    in sent) == allowed
+
+        mock_send.reset_mock()
+        mock_recv.side_effect = (bytes([b]) for b in
+                                 b'POST /\r\n'
+                                 b'Origin: http://example.com\r\n'
+                                 b'\r\n')
+        client = noggin.compat.socket.mpsocket()
+        self.app._handle_client(client, '1.2.3.4.')
+
+        sent = [c[0][0] for c in mock_send.call_args_list]
+        assert (b'Access-Control-Allow-Origin: http://example.com\r\n'
+                in sent)
+
+
+class TestListeners(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.app = noggin.Noggin()
+
+        @self.app.route('/')
+        def index(req):
+            return 'index'
+
+        @self.app.route('/admin', listeners=['admin'])
+        def admin(req):
+            return 'admin'
+
+    def tearDown(self):
+        self.app.close()
+        shutil.rmtree(self.tmpdir)
+
+    def request(self, listener, uri):
+        if listener.path:
+            client = socket.socket(socket.AF_UNIX)
+            client.connect(listener.path)
+        else:
+            client = socket.socket()
+            client.connect(listener.socket.getsockname())
+
+        client.sendall('GET {} HTTP/1.1\r\n\r\n'.format(uri).encode())
+        self.app._accept_ready(1000)
+
+        response = b''
+        while True:
+            buf = client.recv(1024)
+            if not buf:
+                break
+            response += buf
+
+        client.close()
+        return response.split(b'\r\n')[0], response.split(b'\r\n')[-1]
+
+    def test_multiple_listeners(self):
+
+        '''Can we serve connections from TCP and Unix domain sockets,
+        with routes restricted to particular listeners?'''
+
+        public = self.app.listen(0, host='127.0.0.1', name='public')
+        admin = self.app.listen(path=os.path.join(self.tmpdir, 'sock'),
+                                name='admin')
+        self.app._open_listeners()
+
+        assert (self.request(public, '/') ==
+                (b'HTTP/1.1 200 Okay', b'index'))
+        assert (self.request(admin, '/') ==
+                (b'HTTP/1.1 200 Okay', b'index'))
+        assert (self.request(admin, '/admin') ==
+                (b'HTTP/1.1 200 Okay', b'admin'))
+        assert (self.request(public, '/admin')[0] ==
+                b'HTTP/1.1 404 Not Found')
+
+    def test_socket_path_exists(self):
+
+        '''Is a stale Unix domain socket replaced, while any other file
+        at the socket path is left alone?'''
+
+        path = os.path.join(self.tmpdir, 'sock')
+        listener = self.app.listen(path=path)
+        listener.open()
+        listener.close()
+        listener.open()
+        listener.close()
+
+        os.remove(path)
+        with open(path, 'w') as fd:
+            fd.write('important')
+
+        with self.assertRaises(OSError):
+            listener.open()
+
+        with open(path) as fd:
+            assert fd.read() == 'important'
+
+    def test_stalled_upload(self):
+
+        '''Does a client that stops part way through sending a request
+        body hold up other requests?'''
+
+        @self.app.route('/upload', methods=['PUT'])
+        def upload(req):
+            data = b''
+            for chunk in req.iter_content():
+                data += chunk
+                yield b''
+            yield data
+
+        public = self.app.listen(0, host='127.0.0.1', name='public')
+        self.app._open_listeners()
+
+        uploader = socket.socket()
+        uploader.connect(public.socket.getsockname())
+        uploader.sendall(b'PUT /upload HTTP/1.1\r\n'
+                         b'Content-length: 10\r\n'
+                         b'\r\n'
+                         b'abcde')
+        self.app._accept_ready(1000)
+
+        # Stop a failure from hanging the test.
+        self.app._tasks[0][0].raw.settimeout(5)
+
+        for i in range(5):
+            self.app._run_tasks()
+
+        assert (self.request(public, '/') ==
+                (b'HTTP/1.1 200 Okay', b'index'))
+        assert len(self.app._tasks) == 1
+
+        uploader.sendall(b'fghij')
+        while self.app._tasks:
+            self.app._run_tasks()
+
+        response = uploader.recv(1024)
+        uploader.close()
+        assert response.split(b'\r\n')[-1] == b'abcdefghij'
+
+    def test_listener_limiter(self):
+
+        '''Does a listener's limiter apply only to that listener?'''
+
+        public = self.app.listen(0, host='127.0.0.1', name='public',
+                                 limiter=RateLimiter(rate=1))
+        admin = self.app.listen(path=os.path.join(self.tmpdir, 'sock'),
+                                name='admin')
+        self.app._open_listeners()
+
+        assert self.request(public, '/')[0] == b'HTTP/1.1 200 Okay'
+        assert (self.request(public, '/')[0] ==
+                b'HTTP/1.1 429 Too many requests')
+        assert self.request(admin, '/')[0] == b'HTTP/1.1 200 Okay'
+        assert self.request(admin, '/')[0] == b'HTTP/1.1 200 Okay'
+
+
+class FakeClient():
+    def __init__(self, name, request, log):
+        self.name = name
+        self.rfile = io.BytesIO(request)
+        self.log = log
+
+    def readline(self):
+        return self.rfile.readline()
+
+    def write(self, buf):
+        self.log.append((self.name, bytes(buf)))
+
+    def close(self):
+        self.closed = True
+
+
+class DeadClient(FakeClient):
+    '''A client that has disconnected.'''
+
+    def readinto(self, buf, nbytes=0):
+        raise OSError(errno.ECONNRESET, 'Connection reset')
+
+    def write(self, buf):
+        raise OSError(errno.EPIPE, 'Broken pipe')
+
+
+class TestTasks(TestCase):
+    def setUp(self):
+        self.app = noggin.Noggin(slice_ms=0)
+        self.log = []
+
+        @self.app.route('/count/(.*)')
+        def count(req, n):
+            for i in range(int(n)):
+                yield str(i).encode()
+
+        @self.app.route('/quick')
+        def quick(req):
+            return 'quick'
+
+        @self.app.route('/fail')
+        def fail(req):
+            yield b''
+            raise noggin.HTTPError(409)
+
+    def start(self, name, uri):
+        client = FakeClient(name, 'GET {} HTTP/1.1\r\n\r\n'.format(
+            uri).encode(), self.log)
+        task = self.app._start_client(client, ('1.2.3.4', 1234))
+        if task:
+            self.app._tasks.append(task)
+
+    def content(self, name):
+        return [buf for n, buf in self.log
+                if n == name and not buf.endswith(b'\r\n')]
+
+    def test_round_robin(self):
+
+        '''Are streaming responses interleaved with each other, while
+        simple responses are sent immediately?'''
+
+        self.start('a', '/count/3')
+        self.start('b', '/count/2')
+        self.start('c', '/quick')
+
+        assert self.content('c') == [b'quick']
+        assert len(self.app._tasks) == 2
+
+        while self.app._tasks:
+            self.app._run_tasks()
+
+        order = [(n, buf) for n, buf in self.log
+                 if n != 'c' and not buf.endswith(b'\r\n')]
+        assert order == [('a', b'0'), ('b', b'0'),
+                         ('a', b'1'), ('b', b'1'),
+                         ('a', b'2')]
+
+    def test_deferred_headers(self):
+
+        '''Can a streaming handler raise HTTPError before it sends any
+        content?'''
+
+        self.start('a', '/fail')
+        assert self.log == []
+
+        while self.app._tasks:
+            self.app._run_tasks()
+
+        assert self.log[0] == ('a', b'HTTP/1.1 409 Conflict\r\n')
+
+    def test_deferred_error_middleware(self):
+
+        '''Do on_error and after_response handlers apply to errors
+        raised by a streaming handler before it sends any content?'''
+
+        self.app = noggin.Noggin(slice_ms=0, cors='*')
+
+        @self.app.on_error
+        def not_found(req, err):
+            if isinstance(err, OSError):
+                return noggin.Response(404, content='not found')
+
+        @self.app.route('/missing')
+        def missing(req):
+            yield b''
+            raise OSError(2, 'No such file')
+
+        @self.app.route('/fail')
+        def fail(req):
+            yield b''
+            raise noggin.HTTPError(409)
+
+        for name, uri in (('a', '/missing'), ('b', '/fail')):
+            client = FakeClient(name, 'GET {} HTTP/1.1\r\n'
+                                'Origin: http://example.com\r\n'
+                                '\r\n'.format(uri).encode(), self.log)
+            self.app._handle_client(client, ('1.2.3.4', 1234))
+
+        assert ('a', b'HTTP/1.1 404 Not found\r\n') in self.log
+        assert ('b', b'HTTP/1.1 409 Conflict\r\n') in self.log
+        for name in 'ab':
+            assert (name, b'Access-Control-Allow-Origin: *\r\n') in self.log
+
+    def test_client_disconnected(self):
+
+        '''Is a streaming response for a client that has gone away
+        dropped, without stopping the server?'''
+
+        @self.app.route('/upload', methods=['PUT'])
+        def upload(req):
+            for chunk in req.iter_content():
+                yield b''
+
+        client = DeadClient('a', b'PUT /upload HTTP/1.1\r\n'
+                            b'Content-length: 10\r\n'
+                            b'\r\n', self.log)
+        self.app._tasks.append(
+            self.app._start_client(client, ('1.2.3.4', 1234)))
+
+        self.app._run_tasks()
+
+        assert self.app._tasks == []
+        assert client.closed
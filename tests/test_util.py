@@ -0,0 +1,41 @@
+from unittest import TestCase
+
+from noggin.util import StreamReader
+
+
+class TestStreamReader(TestCase):
+    def test_readline(self):
+
+        '''Can we read lines that span chunk boundaries?'''
+
+        reader = StreamReader([b'hel', b'lo\nwor', b'ld\n', b'end'])
+        assert reader.readline() == b'hello\n'
+        assert reader.readline() == b'world\n'
+        assert reader.readline() == b'end'
+        assert reader.readline() == b''
+
+    def test_readline_limit(self):
+
+        '''Are long lines split at limit bytes?'''
+
+        reader = StreamReader([b'abcdef\n'])
+        assert reader.readline(limit=4) == b'abcd'
+        assert reader.readline(limit=4) == b'ef\n'
+
+    def test_iter_read(self):
+
+        '''Can we mix reading lines and fixed-size blocks?'''
+
+        reader = StreamReader([b'header\nabc', b'def', b'ghi\nnext\n'])
+        assert reader.readline() == b'header\n'
+        assert list(reader.iter_read(6)) == [b'abc', b'def']
+        assert reader.read(4) == b'ghi\n'
+        assert reader.readline() == b'next\n'
+
+    def test_iter_read_eof(self):
+
+        '''Is a short stream reported as an error?'''
+
+        reader = StreamReader([b'abc'])
+        with self.assertRaises(EOFError):
+            reader.read(4)
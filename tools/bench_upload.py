@@ -0,0 +1,115 @@
+'''Benchmark request body throughput under CPython.
+
+This sends a chunked (or content-length) upload to an echo handler like
+the one at /echo2 in examples/demo.py over a socketpair, and reports
+the throughput for each request buffer size.
+
+Usage: PYTHONPATH=. python3 tools/bench_upload.py [--size MB]
+           [--chunk BYTES] [--simple] [--bufsize BYTES ...]
+           [--max-bufsize BYTES]
+'''
+
+import argparse
+import socket
+import threading
+import time
+
+import noggin
+from noggin.app import _install_compat
+
+
+def client(sock, size, chunk, simple):
+    data = b'x' * chunk
+
+    if simple:
+        sock.sendall('PUT /echo2 HTTP/1.1\r\n'
+                     'Content-length: {}\r\n\r\n'.format(size).encode())
+    else:
+        sock.sendall(b'PUT /echo2 HTTP/1.1\r\n'
+                     b'Transfer-encoding: chunked\r\n\r\n')
+
+    sent = 0
+    while sent < size:
+        n = min(chunk, size - sent)
+        if simple:
+            sock.sendall(data[:n])
+        else:
+            sock.sendall(b'%x\r\n' % n + data[:n] + b'\r\n')
+        sent += n
+
+    if not simple:
+        sock.sendall(b'0\r\n\r\n')
+
+
+def drain(sock, received):
+    while True:
+        buf = sock.recv(65536)
+        if not buf:
+            break
+        received[0] += len(buf)
+
+
+def run(app, size, chunk, simple):
+    _install_compat()
+    server, peer = socket.socketpair()
+    received = [0]
+
+    threads = [
+        threading.Thread(target=client, args=(peer, size, chunk, simple)),
+        threading.Thread(target=drain, args=(peer, received)),
+    ]
+
+    t_start = time.perf_counter()
+    for t in threads:
+        t.start()
+
+    app._handle_client(server, ('local', 0))
+    peer.shutdown(socket.SHUT_WR)
+
+    for t in threads:
+        t.join()
+
+    return time.perf_counter() - t_start, received[0]
+
+
+def make_app(**kwargs):
+    app = noggin.Noggin(**kwargs)
+
+    @app.route('/echo2', methods=['PUT', 'POST'])
+    def echo2(req):
+        yield from req.iter_content()
+
+    return app
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--size', type=float, default=4,
+                   help='upload size in MB')
+    p.add_argument('--chunk', type=int, default=4096,
+                   help='size of each chunk sent by the client')
+    p.add_argument('--simple', action='store_true',
+                   help='use content-length rather than chunked encoding')
+    p.add_argument('--bufsize', type=int, nargs='+',
+                   default=[256, 1024, 4096, 16384],
+                   help='request buffer sizes to compare')
+    p.add_argument('--max-bufsize', type=int,
+                   help='let the buffer grow up to this size')
+    args = p.parse_args()
+
+    size = int(args.size * 1024 * 1024)
+    results = []
+    for bufsize in args.bufsize:
+        app = make_app(bufsize=bufsize, max_bufsize=args.max_bufsize)
+        elapsed, received = run(app, size, args.chunk, args.simple)
+        results.append((bufsize, elapsed, received))
+
+    for bufsize, elapsed, received in results:
+        print('bufsize {:>6}: {} bytes in {:.3f}s ({:.2f} MB/s), '
+              '{} bytes echoed'.format(
+                  bufsize, size, elapsed, size / elapsed / 1024 / 1024,
+                  received))
+
+
+if __name__ == '__main__':
+    main()
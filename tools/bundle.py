@@ -0,0 +1,47 @@
+'''Concatenate noggin modules into a single module suitable for
+compiling with mpy-cross or freezing into firmware.
+
+Usage: python tools/bundle.py output.py noggin/util.py noggin/app.py ...
+
+Top-level imports of other bundled modules (e.g. "from noggin.util
+import chunked_reader") are dropped, since those names are already
+defined in the bundle, and each module's __all__ is added to the
+previous ones rather than replacing them. Imports inside functions are
+left alone, so
+optional features such as the status text table in noggin/http.py are
+still loaded lazily (and fall back gracefully if they are not present
+on the board).
+'''
+
+import sys
+
+
+def module_name(path):
+    return path[:-3].replace('/', '.').replace('.__init__', '')
+
+
+def bundle(output, sources):
+    bundled = [module_name(src) for src in sources]
+    have_all = False
+
+    with open(output, 'w') as out:
+        out.write('# Generated by tools/bundle.py from: {}\n'.format(
+            ' '.join(sources)))
+
+        for src in sources:
+            out.write('\n# --- {} ---\n'.format(src))
+            with open(src) as fd:
+                for line in fd:
+                    words = line.split()
+                    if line.startswith(('from ', 'import ')):
+                        if words[1] in bundled:
+                            continue
+                    elif line.startswith('__all__ = '):
+                        if have_all:
+                            line = '__all__ += ' + line[len('__all__ = '):]
+                        have_all = True
+                    out.write(line)
+
+
+if __name__ == '__main__':
+    bundle(sys.argv[1], sys.argv[2:])
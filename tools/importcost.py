@@ -0,0 +1,81 @@
+'''Measure the time and heap required to import noggin and serve a
+first request.
+
+Run this on your board ("make importcost", after either "make install"
+or "make install-bundle") or under CPython:
+
+    PYTHONPATH=. python3 tools/importcost.py      # the package
+    PYTHONPATH=build python3 tools/importcost.py  # the bundle
+'''
+
+import gc
+import sys
+
+try:
+    from time import ticks_us, ticks_diff
+except ImportError:
+    import time
+
+    def ticks_us():
+        return int(time.perf_counter() * 1000000)
+
+    def ticks_diff(a, b):
+        return a - b
+
+try:
+    mem_free = gc.mem_free
+except AttributeError:
+    import tracemalloc
+    tracemalloc.start()
+
+    def mem_free():
+        return -tracemalloc.get_traced_memory()[0]
+
+
+class FakeSocket():
+    '''Just enough of a socket to run one request through noggin.'''
+
+    def __init__(self, request):
+        self.lines = request.splitlines(True)
+
+    def readline(self):
+        return self.lines.pop(0) if self.lines else b''
+
+    def write(self, buf):
+        return len(buf)
+
+    def close(self):
+        pass
+
+
+def main():
+    gc.collect()
+    mem_before = mem_free()
+    t_start = ticks_us()
+
+    import noggin
+
+    t_import = ticks_us()
+    gc.collect()
+    mem_import = mem_free()
+
+    app = noggin.Noggin()
+
+    @app.route('/')
+    def index(req):
+        return 'ok'
+
+    app._handle_client(FakeSocket(b'GET / HTTP/1.1\r\n\r\n'),
+                       ('127.0.0.1', 0))
+    t_response = ticks_us()
+    gc.collect()
+
+    print('import: {} us, {} bytes'.format(
+        ticks_diff(t_import, t_start), mem_before - mem_import))
+    print('first response: {} us, {} bytes'.format(
+        ticks_diff(t_response, t_start), mem_before - mem_free()))
+    print('modules: {}'.format(
+        ' '.join(sorted(m for m in sys.modules if 'noggin' in m))))
+
+
+main()